@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
+import os
 import sys
 import re
-import tkinter as tk
-from tkinter import messagebox
 import subprocess
 import socket
 import time
+import tempfile
 import threading
+from itertools import chain, islice
 
 # Configuration Variables
 ESTIMATOR_PATH = "/Applications/klipper_estimator_osx"
 MOONRAKER_URL = "http://192.168.1.4:7125"
 MOONRAKER_TIMEOUT = 3  # Timeout in seconds for connectivity check
+GCODE_WRITE_BUFFER = 1 << 20  # Write buffer in bytes when writing full G-code files
 
 # Default Heat Soak Time in minutes
 DEFAULT_HEAT_SOAK_TIME = "5.0"
@@ -23,12 +25,26 @@ ENABLE_KLIPPER_ESTIMATOR = True
 ENABLE_BRIM_DETECTION = False
 ENABLE_TOOLCHANGE_M104_WAIT = True
 
+# Precompiled regex patterns used by the G-code processing steps
+_POLYGON_RE = re.compile(r'POLYGON=\[\[(.*?)\]\]')
+_BRIM_GAP_RE = re.compile(r'brim_object_gap[ \t]*=[ \t]*([0-9]*\.?[0-9]+)')
+_START_PRINT_RE = re.compile(rb'START_PRINT\s+([^;\n]*)[;\n]')
+_SOAK_TIME_RE = re.compile(rb'SOAK_TIME=\S+')
+_BRIM_SECTION_RE = re.compile(r'^[ \t]*;(?:TYPE:(?P<type>[^\n]*)|WIDTH:(?P<width>[^:\n]*))', re.MULTILINE)
+_G1_XY_RE = re.compile(r'^[ \t]*G1 (?=.*?X([0-9.-]+))(?=.*?Y([0-9.-]+))', re.MULTILINE)
+_INITIAL_TOOL_RE = re.compile(r'^T([0-5])\s*')
+_T_RE = re.compile(r'^T(\d+)\b', re.IGNORECASE)
+_M104_RE = re.compile(r'^M104\b', re.IGNORECASE)
+_S_RE = re.compile(r'\bS\s*(-?\d+(?:\.\d+)?)\b', re.IGNORECASE)
+
 # Global variable to store moonraker connectivity result
 moonraker_connectivity = {"checked": True, "connected": True, "message": ""}
 
 def show_auto_close_popup():
     """Show a popup for 2 seconds indicating that a blank STL is being uploaded to cancel the slice."""
     try:
+        import tkinter as tk
+        
         root = tk.Tk()
         root.title("Canceling Slice")
         root.geometry("350x100")
@@ -60,6 +76,8 @@ def show_auto_close_popup():
 def show_error_popup(error_message):
     """Show a popup that displays the error message and stays open until user closes it."""
     try:
+        import tkinter as tk
+        
         root = tk.Tk()
         root.title("Processing Error")
         root.geometry("500x200")
@@ -110,6 +128,63 @@ def show_error_popup(error_message):
         # If popup fails, just continue
         pass
 
+def show_brim_warning(brim_width):
+    """Ask the user to accept or abort when the detected brim margin is unusually large."""
+    import tkinter as tk
+    
+    root = tk.Tk()
+    root.title("Brim Width Warning")
+    root.geometry("400x140")
+    root.resizable(False, False)
+    root.configure(bg="#f0f0f0")
+    
+    root.attributes('-topmost', True)
+    
+    screen_width = root.winfo_screenwidth()
+    screen_height = root.winfo_screenheight()
+    x = (screen_width - 400) // 2
+    y = (screen_height - 140) // 2
+    root.geometry(f"400x140+{x}+{y}")
+    
+    user_accepted = [False]  # Flag to track if user accepted
+    user_closed_window = [True]  # Flag to track if window was closed without selection
+    
+    main_frame = tk.Frame(root, bg="#f0f0f0", padx=20, pady=20)
+    main_frame.place(relx=0.5, rely=0.5, anchor=tk.CENTER)
+    
+    warning_label = tk.Label(main_frame, text=f"Warning: Detected brim margin is {brim_width:.2f}mm", 
+                           font=("Arial", 12, "bold"), bg="#f0f0f0", fg="#cc0000")
+    warning_label.grid(row=0, column=0, columnspan=2, pady=(0, 20))
+    
+    def accept_and_close():
+        user_accepted[0] = True
+        user_closed_window[0] = False
+        root.destroy()
+    
+    def abort_and_close():
+        user_accepted[0] = False
+        user_closed_window[0] = False
+        root.destroy()
+    
+    button_frame = tk.Frame(main_frame, bg="#f0f0f0")
+    button_frame.grid(row=1, column=0, columnspan=2)
+    
+    accept_button = tk.Button(button_frame, text="Accept", width=14, height=2, 
+                            command=accept_and_close, bg="#e6e6e6", relief=tk.RAISED, font=("Arial", 10))
+    accept_button.grid(row=0, column=0, padx=10)
+    
+    abort_button = tk.Button(button_frame, text="Abort", width=14, height=2, 
+                           command=abort_and_close, bg="#e6e6e6", relief=tk.RAISED, font=("Arial", 10))
+    abort_button.grid(row=0, column=1, padx=10)
+    
+    root.mainloop()
+    
+    # After mainloop exits, check the result
+    if user_closed_window[0] or not user_accepted[0]:
+        raise Exception("Brim width warning aborted: Large brim margin detected and user chose to abort processing")
+    
+    return True
+
 def handle_error_and_exit(gcode_file, error_message):
     """Handle any error by showing popup with error, wiping gcode file, and exiting cleanly."""
     # Show the error popup (stays open until user closes)
@@ -125,15 +200,15 @@ def handle_error_and_exit(gcode_file, error_message):
     # Exit cleanly
     sys.exit(0)
 
-def check_moonraker_connectivity():
-    """Check if Moonraker server is accessible with a short timeout."""
+def parse_moonraker_url(url):
+    """Split a Moonraker URL into (host, port). Port is None if it is not a valid number."""
     # Extract the host and port from the Moonraker URL
-    if MOONRAKER_URL.startswith("http://"):
-        host_port = MOONRAKER_URL[7:]  # remove http://
-    elif MOONRAKER_URL.startswith("https://"):
-        host_port = MOONRAKER_URL[8:]  # remove https://
+    if url.startswith("http://"):
+        host_port = url[7:]  # remove http://
+    elif url.startswith("https://"):
+        host_port = url[8:]  # remove https://
     else:
-        host_port = MOONRAKER_URL
+        host_port = url
     
     # Split host and port
     if ":" in host_port:
@@ -144,29 +219,33 @@ def check_moonraker_connectivity():
         try:
             port = int(port_str)
         except ValueError:
-            return False, f"Invalid port in Moonraker URL: {MOONRAKER_URL}"
+            port = None
     else:
         # Default to port 80 if none specified
         host = host_port
         port = 80
     
-    # Create a socket and set a timeout
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(MOONRAKER_TIMEOUT)
+    return host, port
+
+# MOONRAKER_URL is a constant, so parse it once at import
+MOONRAKER_HOST, MOONRAKER_PORT = parse_moonraker_url(MOONRAKER_URL)
+
+def check_moonraker_connectivity():
+    """Check if Moonraker server is accessible with a short timeout."""
+    host, port = MOONRAKER_HOST, MOONRAKER_PORT
+    if port is None:
+        return False, f"Invalid port in Moonraker URL: {MOONRAKER_URL}"
     
     try:
-        # Try to connect to the host:port
+        # Try to connect to the host:port (tries every resolved address, closes on exit)
         start_time = time.time()
-        s.connect((host, port))
-        end_time = time.time()
-        s.close()
+        with socket.create_connection((host, port), timeout=MOONRAKER_TIMEOUT):
+            end_time = time.time()
         return True, f"Connected to Moonraker at {host}:{port} in {end_time - start_time:.2f}s"
     except socket.timeout:
         return False, f"Connection to Moonraker at {host}:{port} timed out after {MOONRAKER_TIMEOUT}s"
     except socket.error as e:
         return False, f"Failed to connect to Moonraker at {host}:{port}: {str(e)}"
-    finally:
-        s.close()
 
 def background_connectivity_check():
     """Function to run in a background thread to check Moonraker connectivity."""
@@ -197,10 +276,7 @@ def wait_for_connectivity_check(thread):
     # If the connectivity check hasn't completed yet, wait for it
     if thread and thread.is_alive():
         max_wait = MOONRAKER_TIMEOUT
-        start_time = time.time()
-        
-        while thread.is_alive() and time.time() - start_time < max_wait:
-            time.sleep(0.1)  # Small sleep to prevent CPU spinning
+        thread.join(timeout=max_wait)
         
         # If thread is still running after timeout, it's likely stuck
         if thread.is_alive():
@@ -217,18 +293,18 @@ def detect_and_inject_brim_width(gcode_file, lines):
     object_bounds = None
     for line in lines:
         if line.startswith("EXCLUDE_OBJECT_DEFINE"):
-            polygon_match = re.search(r'POLYGON=\[\[(.*?)\]\]', line)
+            polygon_match = _POLYGON_RE.search(line)
             if polygon_match:
                 try:
                     coords_str = polygon_match.group(1)
-                    coords = []
-                    for pair in coords_str.split('],['):
-                        x, y = pair.strip('[]').split(',')
-                        coords.append((float(x), float(y)))
+                    # Parse all vertices as one flat x,y,x,y,... list; each pair must hold exactly two values
+                    values = [float(v) for v in coords_str.replace('[', '').replace(']', '').split(',')]
+                    if len(values) != 2 * (coords_str.count('],[') + 1):
+                        continue
                     
-                    if coords:
-                        x_coords = [coord[0] for coord in coords]
-                        y_coords = [coord[1] for coord in coords]
+                    if values:
+                        x_coords = values[0::2]
+                        y_coords = values[1::2]
                         obj_x_min, obj_x_max = min(x_coords), max(x_coords)
                         obj_y_min, obj_y_max = min(y_coords), max(y_coords)
                         object_bounds = (obj_x_min, obj_x_max, obj_y_min, obj_y_max)
@@ -236,73 +312,72 @@ def detect_and_inject_brim_width(gcode_file, lines):
                 except:
                     continue
     
-    # Look for brim_object_gap in comments - search the LAST 200 lines instead
-    brim_gap = 0.0
-    search_start = max(0, len(lines) - 2000)
-    for line in lines[search_start:]:  # Search last 2000 lines for settings
-        stripped = line.strip()
-        if "brim_object_gap" in stripped:
-            try:
-                # More flexible regex to handle various whitespace patterns
-                gap_match = re.search(r'brim_object_gap\s*=\s*([0-9]*\.?[0-9]+)', stripped)
-                if gap_match:
-                    brim_gap = float(gap_match.group(1))
-                    break
-            except:
-                continue
+    gcode_text = ''.join(lines)
     
-    # Find brim section
+    # Look for brim_object_gap in the settings comments within the last 2000 lines,
+    # searching the joined text in place from where those lines start
+    brim_gap = 0.0
+    tail_start = len(gcode_text) - sum(map(len, islice(reversed(lines), 2000)))
+    gap_idx = gcode_text.find("brim_object_gap", tail_start)
+    if gap_idx != -1:
+        gap_match = _BRIM_GAP_RE.search(gcode_text, gap_idx)
+        if gap_match:
+            brim_gap = float(gap_match.group(1))
+    
+    # Find brim section (as character offsets into the joined G-code). Only ;TYPE: and
+    # ;WIDTH: comment lines are visited, the regex engine skips everything else.
     brim_start = -1
     brim_end = -1
     line_width = None
     
-    for i, line in enumerate(lines):
-        stripped = line.strip()
-        
-        if stripped == ";TYPE:Brim":
-            brim_start = i
-        elif brim_start != -1 and brim_end == -1 and stripped.startswith(";WIDTH:"):
+    for marker_match in _BRIM_SECTION_RE.finditer(gcode_text):
+        feature_type = marker_match.group('type')
+        if feature_type is not None:
+            if feature_type.rstrip() == "Brim":
+                brim_start = marker_match.start()
+            elif brim_start != -1:
+                brim_end = marker_match.start()
+                break
+        elif brim_start != -1:
             try:
-                line_width = float(stripped.split(":")[1])
-            except:
+                line_width = float(marker_match.group('width'))
+            except ValueError:
                 pass
-        elif brim_start != -1 and stripped.startswith(";TYPE:") and stripped != ";TYPE:Brim":
-            brim_end = i
-            break
     
     if brim_start != -1 and line_width is not None and object_bounds is not None:
-        # Extract coordinates from brim section, but exclude interior brims
-        brim_coords = []
-        end_idx = brim_end if brim_end != -1 else len(lines)
+        # Track exterior brim bounds while scanning, excluding interior brims
+        brim_count = 0
+        brim_x_min = brim_y_min = float('inf')
+        brim_x_max = brim_y_max = float('-inf')
+        end_idx = brim_end if brim_end != -1 else len(gcode_text)
         obj_x_min, obj_x_max, obj_y_min, obj_y_max = object_bounds
         obj_center_x = (obj_x_min + obj_x_max) / 2
         obj_center_y = (obj_y_min + obj_y_max) / 2
         
-        for i in range(brim_start, end_idx):
-            line = lines[i].strip()
-            if line.startswith("G1 ") and "X" in line and "Y" in line:
-                try:
-                    x_match = re.search(r'X([0-9.-]+)', line)
-                    y_match = re.search(r'Y([0-9.-]+)', line)
-                    if x_match and y_match:
-                        x = float(x_match.group(1))
-                        y = float(y_match.group(1))
-                        
-                        # Only include coordinates that are OUTSIDE the object bounds
-                        # This excludes interior brims (holes, etc.)
-                        if (x < obj_x_min - 0.1 or x > obj_x_max + 0.1 or 
-                            y < obj_y_min - 0.1 or y > obj_y_max + 0.1):
-                            brim_coords.append((x, y))
-                except:
-                    continue
-        
-        if len(brim_coords) > 10:
-            # Get brim bounds (only exterior brim centerlines)
-            x_coords = [coord[0] for coord in brim_coords]
-            y_coords = [coord[1] for coord in brim_coords]
-            brim_x_min, brim_x_max = min(x_coords), max(x_coords)
-            brim_y_min, brim_y_max = min(y_coords), max(y_coords)
+        # Pull every G1 X/Y pair out of the brim section in a single regex pass
+        for move_match in _G1_XY_RE.finditer(gcode_text, brim_start, end_idx):
+            try:
+                x = float(move_match.group(1))
+                y = float(move_match.group(2))
+            except ValueError:
+                continue
             
+            # Only include coordinates that are OUTSIDE the object bounds
+            # This excludes interior brims (holes, etc.)
+            if (x < obj_x_min - 0.1 or x > obj_x_max + 0.1 or 
+                y < obj_y_min - 0.1 or y > obj_y_max + 0.1):
+                brim_count += 1
+                if x < brim_x_min:
+                    brim_x_min = x
+                if x > brim_x_max:
+                    brim_x_max = x
+                if y < brim_y_min:
+                    brim_y_min = y
+                if y > brim_y_max:
+                    brim_y_max = y
+        
+        # Brim bounds (only exterior brim centerlines) are only trusted with enough samples
+        if brim_count > 10:
             # Account for line width - coordinates are centerlines, so add half line width to get true edges
             half_line_width = line_width / 2
             true_brim_x_min = brim_x_min - half_line_width
@@ -326,65 +401,7 @@ def detect_and_inject_brim_width(gcode_file, lines):
             
             # Check if brim width is > 15mm and show warning popup
             if brim_width > 15:
-                def show_brim_warning():
-                    import tkinter as tk
-                    from tkinter import messagebox
-                    
-                    root = tk.Tk()
-                    root.title("Brim Width Warning")
-                    root.geometry("400x140")
-                    root.resizable(False, False)
-                    root.configure(bg="#f0f0f0")
-                    
-                    root.attributes('-topmost', True)
-                    
-                    screen_width = root.winfo_screenwidth()
-                    screen_height = root.winfo_screenheight()
-                    x = (screen_width - 400) // 2
-                    y = (screen_height - 140) // 2
-                    root.geometry(f"400x140+{x}+{y}")
-                    
-                    user_accepted = [False]  # Flag to track if user accepted
-                    user_closed_window = [True]  # Flag to track if window was closed without selection
-                    
-                    main_frame = tk.Frame(root, bg="#f0f0f0", padx=20, pady=20)
-                    main_frame.place(relx=0.5, rely=0.5, anchor=tk.CENTER)
-                    
-                    warning_label = tk.Label(main_frame, text=f"Warning: Detected brim margin is {brim_width:.2f}mm", 
-                                           font=("Arial", 12, "bold"), bg="#f0f0f0", fg="#cc0000")
-                    warning_label.grid(row=0, column=0, columnspan=2, pady=(0, 20))
-                    
-                    def accept_and_close():
-                        user_accepted[0] = True
-                        user_closed_window[0] = False
-                        root.destroy()
-                    
-                    def abort_and_close():
-                        user_accepted[0] = False
-                        user_closed_window[0] = False
-                        root.destroy()
-                    
-                    button_frame = tk.Frame(main_frame, bg="#f0f0f0")
-                    button_frame.grid(row=1, column=0, columnspan=2)
-                    
-                    accept_button = tk.Button(button_frame, text="Accept", width=14, height=2, 
-                                            command=accept_and_close, bg="#e6e6e6", relief=tk.RAISED, font=("Arial", 10))
-                    accept_button.grid(row=0, column=0, padx=10)
-                    
-                    abort_button = tk.Button(button_frame, text="Abort", width=14, height=2, 
-                                           command=abort_and_close, bg="#e6e6e6", relief=tk.RAISED, font=("Arial", 10))
-                    abort_button.grid(row=0, column=1, padx=10)
-                    
-                    root.mainloop()
-                    
-                    # After mainloop exits, check the result
-                    if user_closed_window[0] or not user_accepted[0]:
-                        raise Exception("Brim width warning aborted: Large brim margin detected and user chose to abort processing")
-                    
-                    return True
-                
-                # Show the warning popup
-                show_brim_warning()
+                show_brim_warning(brim_width)
     
     # Inject the variable if detected
     if brim_width is not None and brim_width > 0:
@@ -415,7 +432,7 @@ def remove_duplicate_tool(gcode_file, lines):
     initial_tool_index = -1
     
     for i, line in enumerate(lines):
-        tool_match = re.match(r'^T([0-5])\s*', line.strip())
+        tool_match = _INITIAL_TOOL_RE.match(line.strip())
         if tool_match:
             initial_tool = tool_match.group(0).split(';')[0].strip()
             initial_tool_index = i
@@ -426,29 +443,29 @@ def remove_duplicate_tool(gcode_file, lines):
     if initial_tool is None:
         status_message = "; Tool selection removal: No initial tool selection (T0-T5) found in G-code"
     else:
+        # The duplicate must come before the first layer change, so find that bound once
+        layer_change_index = next(
+            (i for i in range(initial_tool_index + 1, len(lines)) if ";LAYER_CHANGE" in lines[i]),
+            len(lines),
+        )
+
+        # Look for the second occurrence of the same tool selection
+        second_tool_index = -1
+        for i in range(initial_tool_index + 1, layer_change_index):
+            line = lines[i]
+            if line[:1].isspace():
+                line = line.lstrip()
+            if line.startswith(initial_tool):
+                second_tool_index = i
+                break
+        found_second = second_tool_index != -1
+
         # Special handling for T4 - remove BOTH occurrences
         if initial_tool == "T4":
             # Comment out the first T4
             original_line = lines[initial_tool_index].rstrip()
             lines[initial_tool_index] = f"; REMOVED T4 (FIRST OCCURRENCE): {original_line}\n"
             
-            # Look for the second occurrence of T4
-            found_second = False
-            second_tool_index = -1
-            
-            for i in range(initial_tool_index + 1, len(lines)):
-                line = lines[i].strip()
-                
-                # Stop searching if we hit layer change
-                if ";LAYER_CHANGE" in line:
-                    break
-                    
-                # Check if this line matches T4
-                if line.startswith("T4"):
-                    found_second = True
-                    second_tool_index = i
-                    break
-            
             # Comment out the second occurrence if found
             if found_second:
                 original_line = lines[second_tool_index].rstrip()
@@ -459,23 +476,6 @@ def remove_duplicate_tool(gcode_file, lines):
         
         else:
             # Original logic for all other tools (T0-T3, T5)
-            # Look for the second occurrence of the same tool selection
-            found_second = False
-            second_tool_index = -1
-            
-            for i in range(initial_tool_index + 1, len(lines)):
-                line = lines[i].strip()
-                
-                # Stop searching if we hit layer change
-                if ";LAYER_CHANGE" in line:
-                    break
-                    
-                # Check if this line matches our initial tool
-                if line.startswith(initial_tool):
-                    found_second = True
-                    second_tool_index = i
-                    break
-            
             # Comment out the second occurrence if found
             if found_second:
                 original_line = lines[second_tool_index].rstrip()
@@ -491,6 +491,7 @@ def remove_filament_swap_spiral(gcode_file, lines):
     first   = "G2 Z0.4 I0.86 J0.86 P1 F10000 ; spiral lift a little from second lift\n"
     second  = "G1 X0 Y245 F30000\n"
     third   = "G1 Z0 F600\n"
+    sequence = (first, second, third)
 
     removed = False
     reason = ""
@@ -500,28 +501,28 @@ def remove_filament_swap_spiral(gcode_file, lines):
     second_pos = -1
     third_pos = -1
     
-    # Scan for the block, allowing other lines in between
-    n = len(lines)
-    for i in range(n):
+    # Scan for the block, allowing other lines in between. Only the next expected
+    # line of the sequence is compared, and all three start with 'G', so any other
+    # line only needs checking against the filament start marker.
+    found = []
+    expected = first
+    for i, line in enumerate(lines):
+        if line[:1] == 'G':
+            if line == expected:
+                found.append(i)
+                if len(found) == 3:
+                    first_pos, second_pos, third_pos = found
+                    # Found all three in the correct order - comment out these three lines
+                    lines[third_pos] = f"; REMOVED FILAMENT SWAP SPIRAL (PART 3/3): {lines[third_pos].rstrip()}\n"
+                    lines[second_pos] = f"; REMOVED FILAMENT SWAP SPIRAL (PART 2/3): {lines[second_pos].rstrip()}\n"
+                    lines[first_pos] = f"; REMOVED FILAMENT SWAP SPIRAL (PART 1/3): {lines[first_pos].rstrip()}\n"
+                    removed = True
+                    break
+                expected = sequence[len(found)]
         # If we hit the filament start marker first, give up
-        if lines[i].strip() == "; filament start gcode":
+        elif line.strip() == "; filament start gcode":
             reason = "hit '; filament start gcode' before finding complete sequence"
             break
-            
-        # Look for our key lines in order
-        if first_pos == -1 and lines[i] == first:
-            first_pos = i
-        elif first_pos != -1 and second_pos == -1 and lines[i] == second:
-            second_pos = i
-        elif first_pos != -1 and second_pos != -1 and third_pos == -1 and lines[i] == third:
-            third_pos = i
-            # Found all three in the correct order - comment out these three lines
-            # Comment from last to first to avoid index shifting
-            lines[third_pos] = f"; REMOVED FILAMENT SWAP SPIRAL (PART 3/3): {lines[third_pos].rstrip()}\n"
-            lines[second_pos] = f"; REMOVED FILAMENT SWAP SPIRAL (PART 2/3): {lines[second_pos].rstrip()}\n"
-            lines[first_pos] = f"; REMOVED FILAMENT SWAP SPIRAL (PART 1/3): {lines[first_pos].rstrip()}\n"
-            removed = True
-            break
 
     if not removed and not reason:
         reason = "filament swap spiral sequence not found in expected format"
@@ -545,66 +546,100 @@ def replace_m104_after_toolchange(lines):
     toolchange_count = 0
     inserted_count = 0
     low_temp_count = 0
+    # (index, line) pairs to splice in once the scan is done, so indices stay valid
+    pending_inserts = []
 
-    i = 0
     n = len(lines)
-    while i < n:
+    start_marker = "; CP TOOLCHANGE START"
+    # Jump from one start marker to the next with C-level searches on the joined text instead
+    # of testing every line in Python; only the lines inside blocks are walked one by one.
+    # Every line but the last ends in exactly one newline, so counting newlines gives line indices.
+    joined = ''.join(lines)
+    i = 0
+    line_offset = 0  # offset of lines[i] in joined
+    search_from = 0
+    while True:
+        marker_pos = joined.find(start_marker, search_from)
+        if marker_pos == -1:
+            break
+
+        # Move to the line containing the match
+        i += joined.count('\n', line_offset, marker_pos)
+        line_offset = joined.rfind('\n', 0, marker_pos) + 1
         line = lines[i]
-        if line.lstrip().startswith("; CP TOOLCHANGE START"):
-            toolchange_count += 1
-
-            # Find the end of this toolchange block
-            end_idx = i + 1
-            while end_idx < n and not lines[end_idx].lstrip().startswith("; CP TOOLCHANGE END"):
-                end_idx += 1
-
-            # Find the last T<number> within the block
-            last_t_index = -1
-            for idx in range(i + 1, min(end_idx, n)):
-                stripped = lines[idx].lstrip()
-                if stripped.startswith(';'):
-                    continue
-                if re.match(r'^T(\d+)\b', stripped, flags=re.IGNORECASE):
-                    last_t_index = idx
-
-            if last_t_index != -1:
-                # Find the last M104 with S after the last T within the block
-                last_m104_index = -1
-                last_m104_s_str = None
-                for idx in range(last_t_index + 1, min(end_idx, n)):
-                    stripped = lines[idx].lstrip()
-                    if stripped.startswith(';'):
-                        continue
-                    if re.match(r'^M104\b', stripped, flags=re.IGNORECASE):
-                        s_match = re.search(r'\bS\s*(-?\d+(?:\.\d+)?)\b', stripped, flags=re.IGNORECASE)
-                        if s_match:
-                            last_m104_index = idx
-                            last_m104_s_str = s_match.group(1)
-
-                if last_m104_index != -1 and last_m104_s_str is not None:
-                    try:
-                        s_value = float(last_m104_s_str)
-                    except Exception:
-                        s_value = None
-
-                    if s_value is not None and s_value >= 200:
-                        min_str = f"{s_value - 2:g}"
-                        max_str = f"{s_value + 2:g}"
-                        leading_ws_match = re.match(r'^(\s*)', lines[last_m104_index])
-                        leading_ws = leading_ws_match.group(1) if leading_ws_match else ''
-                        inserted_line = (
-                            f"{leading_ws}TEMPERATURE_WAIT SENSOR=extruder MINIMUM={min_str} MAXIMUM={max_str} "
-                            f";M104 S{last_m104_s_str} wait inserted.\n"
-                        )
-                        lines.insert(last_m104_index + 1, inserted_line)
-                        inserted_count += 1
-                    else:
-                        low_temp_count += 1
-
-            # Advance to after the end marker (or EOF if not found)
-            i = end_idx + 1 if end_idx < n else n
-        else:
-            i += 1
+        # Only pay for lstrip() when the line actually starts with whitespace
+        stripped = line.lstrip() if line[:1].isspace() else line
+        if not stripped.startswith(start_marker):
+            # Marker text elsewhere in a line, keep searching after it
+            search_from = marker_pos + len(start_marker)
+            continue
+
+        toolchange_count += 1
+
+        # Walk the block once: find its end marker, the last T<number>, and the
+        # last M104 with S after that T (a later T resets the M104 candidate)
+        last_t_index = -1
+        last_m104_index = -1
+        last_m104_s_str = None
+        end_idx = i + 1
+        while end_idx < n:
+            line = lines[end_idx]
+            stripped = line.lstrip() if line[:1].isspace() else line
+            # Cheap first-character test before paying for the regex
+            first_char = stripped[:1]
+            if first_char == ';':
+                if stripped.startswith("; CP TOOLCHANGE END"):
+                    break
+            elif first_char in ('T', 't'):
+                if _T_RE.match(stripped):
+                    last_t_index = end_idx
+                    last_m104_index = -1
+                    last_m104_s_str = None
+            elif first_char in ('M', 'm') and last_t_index != -1 and _M104_RE.match(stripped):
+                s_match = _S_RE.search(stripped)
+                if s_match:
+                    last_m104_index = end_idx
+                    last_m104_s_str = s_match.group(1)
+            end_idx += 1
+
+        if last_m104_index != -1 and last_m104_s_str is not None:
+            try:
+                s_value = float(last_m104_s_str)
+            except Exception:
+                s_value = None
+
+            if s_value is not None and s_value >= 200:
+                min_str = f"{s_value - 2:g}"
+                max_str = f"{s_value + 2:g}"
+                m104_line = lines[last_m104_index]
+                leading_ws = m104_line[:len(m104_line) - len(m104_line.lstrip())]
+                inserted_line = (
+                    f"{leading_ws}TEMPERATURE_WAIT SENSOR=extruder MINIMUM={min_str} MAXIMUM={max_str} "
+                    f";M104 S{last_m104_s_str} wait inserted.\n"
+                )
+                pending_inserts.append((last_m104_index + 1, inserted_line))
+                inserted_count += 1
+            else:
+                low_temp_count += 1
+
+        # Continue searching after the end marker (or stop at EOF if not found)
+        if end_idx >= n:
+            break
+        line_offset += sum(map(len, lines[i:end_idx + 1]))
+        i = end_idx + 1
+        search_from = line_offset
+    del joined
+
+    # Rebuild the list once with all wait commands spliced in (inserts are already in order)
+    if pending_inserts:
+        new_lines = []
+        prev_idx = 0
+        for insert_idx, inserted_line in pending_inserts:
+            new_lines.extend(lines[prev_idx:insert_idx])
+            new_lines.append(inserted_line)
+            prev_idx = insert_idx
+        new_lines.extend(lines[prev_idx:])
+        lines = new_lines
 
     summary_message = f"; {toolchange_count} toolchanges detected and {inserted_count} wait commands inserted after M104 commands"
     low_temp_warning = None
@@ -616,6 +651,10 @@ def replace_m104_after_toolchange(lines):
     return lines, summary_message, low_temp_warning
 
 def show_heat_soak_gui(gcode_file):
+    # tkinter is imported lazily so runs without any GUI step skip its startup cost
+    import tkinter as tk
+    from tkinter import messagebox
+    
     root = tk.Tk()
     root.title("Heat Soak Time")
     root.geometry("340x160")  # Slightly taller to accommodate status message
@@ -714,26 +753,47 @@ def show_heat_soak_gui(gcode_file):
 
 def apply_heat_soak(gcode_file, soak_time):
     try:
-        with open(gcode_file, 'r', encoding='utf-8') as f:
+        # Read and patch the raw bytes through a single handle, so only the changed part of the file is rewritten
+        with open(gcode_file, 'r+b') as f:
             gcode = f.read()
-        
-        pattern = r'(START_PRINT\s+[^;\n]*?)(\s*;|\s*\n)'
-        
-        def add_soak_time(match):
-            start_print_cmd = match.group(1)
-            line_end = match.group(2)
             
-            if 'SOAK_TIME=' in start_print_cmd:
-                modified_cmd = re.sub(r'SOAK_TIME=\S+', f'SOAK_TIME={soak_time}', start_print_cmd)
-            else:
-                modified_cmd = f"{start_print_cmd} SOAK_TIME={soak_time}"
+            # Nothing to modify (and no need to rewrite the file) without a START_PRINT
+            if b'START_PRINT' not in gcode:
+                return "; Heat soak: START_PRINT not found, no modification"
             
-            return modified_cmd + line_end
-        
-        modified_gcode = re.sub(pattern, add_soak_time, gcode)
-        
-        with open(gcode_file, 'w', encoding='utf-8') as f:
-            f.write(modified_gcode)
+            soak_arg = f"SOAK_TIME={soak_time}".encode('utf-8')
+            
+            # Collect (start, end, replacement) for every START_PRINT command that changes
+            edits = []
+            for match in _START_PRINT_RE.finditer(gcode):
+                # The command ends before any whitespace preceding the ; or newline terminator
+                cmd_end = match.start(1) + len(match.group(1).rstrip())
+                start_print_cmd = gcode[match.start():cmd_end]
+                
+                if b'SOAK_TIME=' in start_print_cmd:
+                    modified_cmd = _SOAK_TIME_RE.sub(soak_arg, start_print_cmd)
+                else:
+                    modified_cmd = start_print_cmd + b" " + soak_arg
+                
+                if modified_cmd != start_print_cmd:
+                    edits.append((match.start(), cmd_end, modified_cmd))
+            
+            if all(len(modified_cmd) == end - start for start, end, modified_cmd in edits):
+                # Same length: overwrite each command in place
+                for start, end, modified_cmd in edits:
+                    f.seek(start)
+                    f.write(modified_cmd)
+            else:
+                # Length changed: rewrite the file from the first changed command onward
+                view = memoryview(gcode)
+                pos = edits[0][0]
+                f.seek(pos)
+                for start, end, modified_cmd in edits:
+                    f.write(view[pos:start])
+                    f.write(modified_cmd)
+                    pos = end
+                f.write(view[pos:])
+                f.truncate()
             
         return f"; Heat soak: Set to {soak_time} minutes in START_PRINT command"
         
@@ -750,12 +810,13 @@ def run_klipper_estimator(gcode_file):
             raise Exception(f"Cannot connect to Moonraker server: {moonraker_connectivity['message']}")
         
         # If we got here, we can connect to Moonraker, so run the estimator
+        # Only stderr is used (for the error message), so stdout is discarded instead of buffered
         cmd = [ESTIMATOR_PATH, "--config_moonraker_url", MOONRAKER_URL, "post-process", gcode_file]
-        process = subprocess.run(cmd, capture_output=True, text=True)
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
         
         # Check if the command was successful - raise exception on failure
-        if process.returncode != 0:
-            error_msg = f"Klipper Estimator failed with error code {process.returncode}. Error: {process.stderr.strip()}"
+        if result.returncode != 0:
+            error_msg = f"Klipper Estimator failed with error code {result.returncode}. Error: {result.stderr.strip()}"
             raise Exception(error_msg)
         
         return None
@@ -770,6 +831,34 @@ def run_klipper_estimator(gcode_file):
         # Catch and re-raise any other exceptions
         raise Exception(f"Klipper Estimator error: {str(e)}")
 
+def write_gcode_lines(gcode_file, lines):
+    """Stream lines into a temporary file next to gcode_file, then swap it into place.
+
+    The original file is only replaced once the new content is fully written, so it can
+    still be read while the replacement is produced.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(gcode_file)), suffix=".tmp")
+    try:
+        with open(fd, "w", encoding='utf-8', buffering=GCODE_WRITE_BUFFER) as f:
+            f.writelines(lines)
+        # Keep the original file's permissions (mkstemp creates the file as 0600)
+        try:
+            os.chmod(tmp_path, os.stat(gcode_file).st_mode & 0o7777)
+        except OSError:
+            pass
+        os.replace(tmp_path, gcode_file)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def status_trailer(status_messages, needs_newline):
+    """Build all status comments as one block to write after the G-code."""
+    # Ensure last line ends with newline, then append all status comments
+    return ("\n" if needs_newline else "") + "".join(message + "\n" for message in status_messages)
+
 def main():
     if len(sys.argv) != 2:
         print("Usage: python combined_script.py <gcode_file>")
@@ -833,13 +922,13 @@ def main():
         else:
             status_messages.append("; Toolchange M104 replacement: Disabled")
 
-        # Write intermediate changes to file
-        try:
-            with open(gcode_file, "w", encoding='utf-8') as f:
-                f.writelines(lines)
-        except Exception as e:
-            # This will cause Orca to abort
-            raise Exception(f"Error writing to G-code file: {str(e)}")
+        # The estimator reads the file from disk, so only then are intermediate changes written out
+        if ENABLE_KLIPPER_ESTIMATOR:
+            try:
+                write_gcode_lines(gcode_file, lines)
+            except Exception as e:
+                # This will cause Orca to abort
+                raise Exception(f"Error writing to G-code file: {str(e)}")
         
         # Wait for connectivity check to complete if it hasn't already
         wait_for_connectivity_check(connectivity_thread)
@@ -849,31 +938,34 @@ def main():
             # This will raise an exception on failure
             run_klipper_estimator(gcode_file)
             status_messages.append("; Klipper Estimator: Successfully run")
+
+            # Append the status comments to the estimator's output instead of rewriting the whole file
+            try:
+                final_file = open(gcode_file, "r+b")
+            except FileNotFoundError:
+                # This will cause Orca to abort
+                raise Exception(f"Error: G-code file '{gcode_file}' not found after running estimator.")
+
+            try:
+                with final_file:
+                    needs_newline = False
+                    if final_file.seek(0, os.SEEK_END) > 0:
+                        final_file.seek(-1, os.SEEK_END)
+                        needs_newline = final_file.read(1) != b"\n"
+                    final_file.write(status_trailer(status_messages, needs_newline).encode('utf-8'))
+            except Exception as e:
+                # This will cause Orca to abort
+                raise Exception(f"Error writing final G-code: {str(e)}")
         else:
             status_messages.append("; Klipper Estimator: Disabled")
-        
-        # Re-read the file (as it may have been modified by the estimator)
-        try:
-            with open(gcode_file, "r", encoding='utf-8') as f:
-                lines = f.readlines()
-        except FileNotFoundError:
-            # This will cause Orca to abort
-            raise Exception(f"Error: G-code file '{gcode_file}' not found after running estimator.")
-
-        # Ensure last line ends with newline, then append all status comments
-        if lines and not lines[-1].endswith("\n"):
-            lines[-1] += "\n"
-        
-        for message in status_messages:
-            lines.append(message + "\n")
 
-        # Write back out with status comments
-        try:
-            with open(gcode_file, "w", encoding='utf-8') as f:
-                f.writelines(lines)
-        except Exception as e:
-            # This will cause Orca to abort
-            raise Exception(f"Error writing final G-code: {str(e)}")
+            # Nothing else touched the file, so write the in-memory lines and status comments once
+            needs_newline = bool(lines) and not lines[-1].endswith("\n")
+            try:
+                write_gcode_lines(gcode_file, chain(lines, [status_trailer(status_messages, needs_newline)]))
+            except Exception as e:
+                # This will cause Orca to abort
+                raise Exception(f"Error writing final G-code: {str(e)}")
     
     except Exception as e:
         # Handle any error by showing popup with error message, wiping file, and exiting cleanly
@@ -1,60 +1,74 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import sys
-import subprocess
+import mmap
+import shutil
 import argparse
 from pathlib import Path
 
 # Configuration
 KLIPPER_EXTRAS_DIR = "/usr/share/klipper/klippy/extras"
 
+# First "minval=3." on each line that has a move_check_distance ... minval=3. (same lines sed used to edit)
+MINVAL_PATTERN = re.compile(r'^(?=.*move_check_distance.*minval=3\.)(.*?)minval=3\.', re.MULTILINE)
+
 def log(message, level="INFO"):
     print(f"[{level}] {message}")
 
-def check_file_exists(path):
-    return os.path.exists(path)
-
-def run_command(command):
-    """Run a command and return the result"""
-    try:
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-        return result
-    except Exception as e:
-        log(f"Command failed: {e}", "ERROR")
-        return None
+def file_contains(path, needle):
+    """Check whether a file contains a byte string without reading and decoding it"""
+    with open(path, 'rb') as f:
+        # mmap cannot map an empty file
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm.find(needle) != -1
 
 def modify_bed_mesh():
     """Modify bed_mesh.py to change minval parameter"""
     log("Modifying bed_mesh.py...")
     
     bed_mesh_path = Path(KLIPPER_EXTRAS_DIR) / "bed_mesh.py"
-    if not check_file_exists(bed_mesh_path):
-        log("bed_mesh.py not found", "ERROR")
-        return False
-        
-    # Check if the modification is already applied
+    
+    # Check if the modification is already applied before reading the whole file
     try:
+        if file_contains(bed_mesh_path, b'minval=1.'):
+            log("bed_mesh.py already has minval=1. (modification not needed)")
+            return True
+            
         with open(bed_mesh_path, 'r') as f:
             content = f.read()
+    except FileNotFoundError:
+        log("bed_mesh.py not found", "ERROR")
+        return False
     except Exception as e:
         log(f"Failed to read bed_mesh.py: {e}", "ERROR")
         return False
         
-    if 'minval=1.' in content:
-        log("bed_mesh.py already has minval=1. (modification not needed)")
+    # Apply the modification in-process and swap the result into place
+    new_content, count = MINVAL_PATTERN.subn(r'\g<1>minval=1.', content)
+    if count == 0:
+        log("bed_mesh.py has no move_check_distance minval=3. (nothing to modify)")
         return True
         
-    # Apply the sed modification
-    sed_command = f"sed -i '/move_check_distance.*minval=3\\./s/minval=3\\./minval=1./' '{bed_mesh_path}'"
-    
-    result = run_command(sed_command)
-    if result and result.returncode == 0:
-        log("bed_mesh.py modified successfully")
-        return True
-    else:
-        log("Failed to modify bed_mesh.py", "ERROR")
+    tmp_path = f"{bed_mesh_path}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(new_content)
+        shutil.copymode(bed_mesh_path, tmp_path)
+        os.replace(tmp_path, bed_mesh_path)
+    except Exception as e:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        log(f"Failed to modify bed_mesh.py: {e}", "ERROR")
         return False
+        
+    log("bed_mesh.py modified successfully")
+    return True
 
 def main():
     parser = argparse.ArgumentParser(description="Bed Mesh Modifier")
@@ -14,61 +14,63 @@ MOONRAKER_ASVC_FILE = "/mnt/UDISK/printer_data/moonraker.asvc"
 def log(message, level="INFO"):
     print(f"[{level}] {message}")
 
-def check_file_exists(path):
-    return os.path.exists(path)
-
-def copy_file(src, dst):
-    if not check_file_exists(src):
+def copy_executable(src, dst):
+    """Copy src to dst and make it executable, through the one destination file descriptor"""
+    try:
+        fsrc = open(src, 'rb')
+    except FileNotFoundError:
         log(f"Source file not found: {src}", "ERROR")
         return False
         
     try:
-        shutil.copy2(src, dst)
-        log(f"Successfully copied {src} to {dst}")
+        with fsrc, open(dst, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst)
+            os.fchmod(fdst.fileno(), 0o755)
+        log(f"Successfully copied {src} to {dst} and made it executable")
         return True
     except Exception as e:
         log(f"Failed to copy {src}: {e}", "ERROR")
         return False
 
+def ensure_asvc_entries(asvc_path, names):
+    """Append any of the given service names missing from an asvc file, returning the added names"""
+    # Check and append through one handle: after the read the position is at EOF
+    with open(asvc_path, 'r+b') as f:
+        content = f.read()
+        
+        # Compare whole lines, so a longer service name containing one of ours doesn't count
+        services = {line.strip() for line in content.decode('utf-8').splitlines()}
+        missing = [name for name in names if name not in services]
+        
+        if missing:
+            entries = "".join(f"{name}\n" for name in missing).encode('utf-8')
+            f.write((b'\n' if content and not content.endswith(b'\n') else b'') + entries)
+    return missing
+
 def install_cleanup_service():
     """Install the cleanup service"""
     log("Installing cleanup service...")
     
-    # Copy the service file
+    # Copy the service file and make it executable
     service_src = REPO_ROOT / "services" / "cleanup_printer_backups"
     service_dst = Path(INIT_D_DIR) / "cleanup_printer_backups"
-    if not copy_file(service_src, service_dst):
-        return False
-        
-    # Make it executable
-    try:
-        os.chmod(service_dst, 0o755)
-        log("Made cleanup service executable")
-    except Exception as e:
-        log(f"Failed to chmod service file: {e}", "ERROR")
+    if not copy_executable(service_src, service_dst):
         return False
         
     # Check if service is already in moonraker.asvc
-    if not check_file_exists(MOONRAKER_ASVC_FILE):
+    try:
+        added = ensure_asvc_entries(MOONRAKER_ASVC_FILE, ['cleanup_printer_backups'])
+    except FileNotFoundError:
         log("moonraker.asvc not found - cannot add service", "ERROR")
         return False
+    except Exception as e:
+        log(f"Failed to update moonraker.asvc: {e}", "ERROR")
+        return False
         
-    with open(MOONRAKER_ASVC_FILE, 'r') as f:
-        content = f.read()
-        
-    if 'cleanup_printer_backups' in content:
-        log("cleanup_printer_backups already in moonraker.asvc")
+    if added:
+        log("Added cleanup_printer_backups to moonraker.asvc")
     else:
-        # Add service to moonraker.asvc
-        try:
-            with open(MOONRAKER_ASVC_FILE, 'a') as f:
-                if not content.endswith('\n'):
-                    f.write('\n')
-                f.write('cleanup_printer_backups\n')
-            log("Added cleanup_printer_backups to moonraker.asvc")
-        except Exception as e:
-            log(f"Failed to update moonraker.asvc: {e}", "ERROR")
-            return False
+        log("cleanup_printer_backups already in moonraker.asvc")
             
     log("Cleanup service installed successfully")
     return True
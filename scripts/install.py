@@ -2,16 +2,51 @@
 
 import os
 import sys
+import time
+import selectors
 import subprocess
-import shutil
-import re
 import argparse
 from pathlib import Path
 
 # Configuration - paths relative to the cloned repository
 REPO_ROOT = Path(__file__).parent.parent.absolute()
+SCRIPTS_DIR = REPO_ROOT / "scripts"
+
+# Component installer scripts, resolved once to plain path strings
+INSTALLER_SCRIPTS = {
+    script_name: os.fspath(SCRIPTS_DIR / script_name)
+    for script_name in (
+        "ustreamer_install.py",
+        "kamp_install.py",
+        "overrides_install.py",
+        "cleanup_install.py",
+        "resonance_install.py",
+        "timelapse_install.py",
+        "bed_mesh_install.py",
+        "mainsail_install.py",
+    )
+}
+
+# Warn when a component installer has been silent for this long
+STALL_WARNING_SECONDS = 60
+
+# Banner printed before each component installer runs
+INSTALL_BANNER = "\n" + ("#"*60) + "\n[INFO] Running {} installer\n" + ("#"*60) + "\n"
 
 class PrinterInstaller:
+    # (component, banner label, install method) in installation order
+    INSTALL_STEPS = (
+        ('ustreamer', 'ustreamer', 'install_ustreamer'),
+        ('kamp', 'kamp', 'install_kamp'),
+        ('overrides', 'overrides', 'install_overrides'),
+        ('cleanup', 'cleanup', 'install_cleanup_service'),
+        ('resonance', 'resonance', 'install_resonance_tester'),
+        ('timelapse', 'timelapse', 'install_timelapse'),
+        ('timelapseh264', 'timelapse (H264)', 'install_timelapse_h264'),
+        ('bed_mesh', 'bed_mesh', 'modify_bed_mesh'),
+        ('mainsail', 'mainsail', 'install_mainsail'),
+    )
+
     def __init__(self):
         self.verbose = True  # Always verbose by default
         
@@ -19,12 +54,12 @@ class PrinterInstaller:
         print(f"[{level}] {message}", flush=True)
         
     def run_command(self, command, capture_output=True):
-        """Run a command locally on the printer"""
+        """Run a command (an argv list, no shell) locally on the printer"""
         if self.verbose:
-            self.log(f"Running: {command}")
+            self.log(f"Running: {' '.join(command)}")
         
         try:
-            result = subprocess.run(command, shell=True, capture_output=capture_output, text=True)
+            result = subprocess.run(command, capture_output=capture_output, text=True)
             if self.verbose and result.stdout:
                 self.log(f"STDOUT: {result.stdout.strip()}")
             if result.stderr:
@@ -48,10 +83,16 @@ class PrinterInstaller:
         return os.path.isdir(os.path.join(path, ".git"))
 
     def get_current_git_branch(self, repo_path):
-        """Get the current git branch for the repository."""
-        result = self.run_command(f"git -C '{repo_path}' rev-parse --abbrev-ref HEAD")
-        if result and result.returncode == 0:
-            branch = (result.stdout or "").strip()
+        """Get the current git branch for the repository (None when HEAD is detached)."""
+        # Read .git/HEAD directly instead of starting git for rev-parse
+        try:
+            with open(os.path.join(repo_path, ".git", "HEAD"), "r") as f:
+                head = f.read().strip()
+        except OSError:
+            return None
+        prefix = "ref: refs/heads/"
+        if head.startswith(prefix):
+            branch = head[len(prefix):]
             return branch if branch else None
         return None
 
@@ -87,7 +128,7 @@ class PrinterInstaller:
 
         self.log(f"Current branch: {current_branch}")
 
-        pull_result = self.run_command(f"git -C '{repo_path}' pull origin {current_branch}")
+        pull_result = self.run_command(["git", "-C", repo_path, "pull", "origin", current_branch])
 
         if pull_result and pull_result.returncode == 0:
             self.log("Repository updated successfully.")
@@ -104,11 +145,12 @@ class PrinterInstaller:
 
         # Force pull path: discard local changes and match origin
         self.log("Forcing repository to match origin (discarding local changes).", "WARN")
-        fetch_res = self.run_command(f"git -C '{repo_path}' fetch origin")
+        # Only the current branch is needed for the reset below
+        fetch_res = self.run_command(["git", "-C", repo_path, "fetch", "origin", current_branch], capture_output=False)
         if not fetch_res or fetch_res.returncode != 0:
             self.log("Failed to fetch from origin. Cannot force pull.", "ERROR")
             return False
-        reset_res = self.run_command(f"git -C '{repo_path}' reset --hard origin/{current_branch}")
+        reset_res = self.run_command(["git", "-C", repo_path, "reset", "--hard", f"origin/{current_branch}"], capture_output=False)
         if not reset_res or reset_res.returncode != 0:
             self.log("Failed to reset to origin. Cannot continue.", "ERROR")
             return False
@@ -118,7 +160,7 @@ class PrinterInstaller:
             
     def run_installer(self, component_name, script_name, extra_args=None):
         """Generic method to run any installer script"""
-        installer_path = REPO_ROOT / "scripts" / script_name
+        installer_path = INSTALLER_SCRIPTS[script_name]
         if not self.check_file_exists(installer_path):
             self.log(f"{component_name} install script not found", "ERROR")
             return False
@@ -126,19 +168,31 @@ class PrinterInstaller:
         # Execute with live output (always verbose)
         try:
             # Force unbuffered output from child installers
-            args_str = " " + " ".join(extra_args) if extra_args else ""
-            command = f"PYTHONUNBUFFERED=1 python3 -u '{installer_path}'{args_str}"
+            command = ["python3", "-u", installer_path] + (extra_args or [])
             process = subprocess.Popen(
                 command,
-                shell=True,
+                env={**os.environ, "PYTHONUNBUFFERED": "1"},
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                universal_newlines=True,
-                bufsize=1,
+                bufsize=0,
             )
-            for line in iter(process.stdout.readline, ''):
-                if line:
-                    print(line.rstrip())
+            # Pass the child's output through as raw chunks, as soon as they arrive
+            # (no per-line decoding and re-encoding), and warn when it goes quiet
+            stdout_fd = process.stdout.fileno()
+            with selectors.DefaultSelector() as selector:
+                selector.register(stdout_fd, selectors.EVENT_READ)
+                last_output = time.monotonic()
+                while True:
+                    if not selector.select(timeout=STALL_WARNING_SECONDS):
+                        silent_for = time.monotonic() - last_output
+                        self.log(f"{component_name} installer has printed nothing for {silent_for:.0f}s (still running)", "WARN")
+                        continue
+                    chunk = os.read(stdout_fd, 65536)
+                    if not chunk:
+                        break
+                    sys.stdout.buffer.write(chunk)
+                    sys.stdout.buffer.flush()
+                    last_output = time.monotonic()
             process.stdout.close()
             return_code = process.wait()
 
@@ -202,50 +256,11 @@ class PrinterInstaller:
         
         results = {}
         
-        if 'ustreamer' in components:
-            print("\n" + ("#"*60) + "\n[INFO] Running ustreamer installer\n" + ("#"*60) + "\n", flush=True)
-            results['ustreamer'] = self.install_ustreamer()
-            
-            
-        if 'kamp' in components:
-            print("\n" + ("#"*60) + "\n[INFO] Running kamp installer\n" + ("#"*60) + "\n", flush=True)
-            results['kamp'] = self.install_kamp()
-            
-            
-        if 'overrides' in components:
-            print("\n" + ("#"*60) + "\n[INFO] Running overrides installer\n" + ("#"*60) + "\n", flush=True)
-            results['overrides'] = self.install_overrides()
-            
-            
-        if 'cleanup' in components:
-            print("\n" + ("#"*60) + "\n[INFO] Running cleanup installer\n" + ("#"*60) + "\n", flush=True)
-            results['cleanup'] = self.install_cleanup_service()
-            
-            
-        if 'resonance' in components:
-            print("\n" + ("#"*60) + "\n[INFO] Running resonance installer\n" + ("#"*60) + "\n", flush=True)
-            results['resonance'] = self.install_resonance_tester()
-            
-            
-        if 'timelapse' in components:
-            print("\n" + ("#"*60) + "\n[INFO] Running timelapse installer\n" + ("#"*60) + "\n", flush=True)
-            results['timelapse'] = self.install_timelapse()
-        
-        if 'timelapseh264' in components:
-            print("\n" + ("#"*60) + "\n[INFO] Running timelapse (H264) installer\n" + ("#"*60) + "\n", flush=True)
-            results['timelapseh264'] = self.install_timelapse_h264()
-            
-            
-        if 'bed_mesh' in components:
-            print("\n" + ("#"*60) + "\n[INFO] Running bed_mesh installer\n" + ("#"*60) + "\n", flush=True)
-            results['bed_mesh'] = self.modify_bed_mesh()
-            
-            
-        if 'mainsail' in components:
-            print("\n" + ("#"*60) + "\n[INFO] Running mainsail installer\n" + ("#"*60) + "\n", flush=True)
-            results['mainsail'] = self.install_mainsail()
-            
-            
+        wanted = frozenset(components)
+        for component, label, method_name in self.INSTALL_STEPS:
+            if component in wanted:
+                print(INSTALL_BANNER.format(label), flush=True)
+                results[component] = getattr(self, method_name)()
             
         # Print summary
         self.log("\n" + "="*50)
@@ -4,6 +4,7 @@ import os
 import sys
 import shutil
 import argparse
+import tempfile
 from pathlib import Path
 
 # Configuration
@@ -13,24 +14,39 @@ CONFIG_DIR = "/mnt/UDISK/printer_data/config"
 def log(message, level="INFO"):
     print(f"[{level}] {message}")
 
-def check_file_exists(path):
-    return os.path.exists(path)
-
 def check_dir_exists(path):
     return os.path.isdir(path)
 
 def copy_file(src, dst):
-    if not check_file_exists(src):
-        log(f"Source file not found: {src}", "ERROR")
-        return False
-        
+    # Just try the copy; a missing source shows up as FileNotFoundError naming it
     try:
-        shutil.copy2(src, dst)
-        log(f"Successfully copied {src} to {dst}")
-        return True
+        shutil.copyfile(src, dst)
+    except FileNotFoundError as e:
+        if e.filename == os.fspath(src):
+            log(f"Source file not found: {src}", "ERROR")
+        else:
+            log(f"Failed to copy {src}: {e}", "ERROR")
+        return False
     except Exception as e:
         log(f"Failed to copy {src}: {e}", "ERROR")
         return False
+    log(f"Successfully copied {src} to {dst}")
+    return True
+
+def atomic_write(path, content):
+    """Write content to a temp file next to path, then swap it into place so path is never left truncated"""
+    path = os.path.realpath(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with open(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
 
 def copy_dir(src, dst):
     if not check_dir_exists(src):
@@ -38,9 +54,13 @@ def copy_dir(src, dst):
         return False
         
     try:
-        if os.path.exists(dst):
+        # Remove any previous copy; nothing to remove on a first install
+        try:
             shutil.rmtree(dst)
-        shutil.copytree(src, dst)
+        except FileNotFoundError:
+            pass
+        # Config files only need their contents, not timestamps and other metadata
+        shutil.copytree(src, dst, copy_function=shutil.copyfile)
         log(f"Successfully copied directory {src} to {dst}")
         return True
     except Exception as e:
@@ -50,38 +70,44 @@ def copy_dir(src, dst):
 def add_include_to_printer_cfg(include_line):
     """Add an include line to printer.cfg"""
     printer_cfg = Path(CONFIG_DIR) / "printer.cfg"
-    if not check_file_exists(printer_cfg):
+    try:
+        with open(printer_cfg, 'r') as f:
+            content = f.read()
+    except FileNotFoundError:
         log("printer.cfg not found - cannot add include line", "ERROR")
         return False
         
-    with open(printer_cfg, 'r') as f:
-        content = f.read()
-        
-    if include_line in content:
+    # Klipper ignores everything after '#' or ';', so '#[include ...]' is inactive but '[include ...]  # note' is not
+    active_lines = {line.split('#', 1)[0].split(';', 1)[0].strip() for line in content.splitlines()}
+    if include_line in active_lines:
         log(f"{include_line} already included in printer.cfg")
         return True
         
     # Add the include line safely
-    lines = content.split('\n')
-    include_lines = []
-    for i, line in enumerate(lines):
-        if line.strip().startswith('[include'):
-            include_lines.append(i)
+    # Find the last line starting with [include by searching back from the end of the file
+    include_pos = content.rfind('[include')
+    while include_pos != -1:
+        line_start = content.rfind('\n', 0, include_pos) + 1
+        if not content[line_start:include_pos].strip():
+            break
+        include_pos = content.rfind('[include', 0, include_pos)
     
-    if include_lines:
+    if include_pos != -1:
         # Insert after the last include line
-        insert_pos = include_lines[-1] + 1
-        lines.insert(insert_pos, include_line)
+        line_end = content.find('\n', include_pos)
+        if line_end == -1:
+            content = content + '\n' + include_line
+        else:
+            content = content[:line_end + 1] + include_line + '\n' + content[line_end + 1:]
     else:
         # If no include lines found, append at the end
         # Ensure file ends with a newline before appending
-        if lines and lines[-1] != '':
-            lines.append('')
-        lines.append(include_line)
+        if content and not content.endswith('\n'):
+            content += '\n'
+        content += '\n' + include_line
         
     # Write back to file
-    with open(printer_cfg, 'w') as f:
-        f.write('\n'.join(lines))
+    atomic_write(printer_cfg, content)
     log(f"Added {include_line} to printer.cfg")
     return True
 
@@ -2,92 +2,133 @@
 
 import os
 import sys
+import re
 import shutil
+import zipfile
+import tempfile
 import subprocess
 import argparse
 from pathlib import Path
 
 # Configuration
 REPO_ROOT = Path(__file__).parent.parent.absolute()
+MAINSAIL_RELEASE_URL = "https://github.com/mainsail-crew/mainsail/releases/latest/download/mainsail.zip"
+# Downloads up to this size stay in memory instead of a temp file
+ZIP_SPOOL_SIZE = 16 * 1024 * 1024
+# Copy buffer used when writing out each extracted file
+EXTRACT_BUFFER_SIZE = 1024 * 1024
+# Matches the section header only at the start of a line, so a commented-out copy does not count
+UPDATE_MANAGER_SECTION_RE = re.compile(rb'^\[update_manager mainsail\]', re.MULTILINE)
 
 def log(message, level="INFO"):
     print(f"[{level}] {message}")
 
-def check_file_exists(path):
-    return os.path.exists(path)
-
 def run_command(command):
-    """Run a command and return the result"""
+    """Run a command (an argv list, no shell) and return the result; only stderr is kept"""
     try:
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
         return result
     except Exception as e:
         log(f"Command failed: {e}", "ERROR")
         return None
 
+def extract_zip(archive, target_dir):
+    """Extract archive into target_dir, creating each directory once and writing files grouped by directory"""
+    directories = set()
+    files = []
+    for info in archive.infolist():
+        # Skip absolute paths and parent references so nothing lands outside target_dir
+        parts = info.filename.replace('\\', '/').split('/')
+        if info.filename.startswith('/') or '..' in parts:
+            log(f"Skipping unsafe archive entry: {info.filename}", "WARN")
+            continue
+        parts = [part for part in parts if part not in ('', '.')]
+        if not parts:
+            continue
+        relative_path = os.path.join(*parts)
+        if info.is_dir():
+            directories.add(relative_path)
+        else:
+            directories.add(os.path.dirname(relative_path))
+            files.append((relative_path, info))
+    
+    # Create the directory tree up front
+    for directory in sorted(directories):
+        os.makedirs(os.path.join(target_dir, directory), exist_ok=True)
+    
+    # Write files directory by directory
+    files.sort(key=lambda item: (os.path.dirname(item[0]), item[0]))
+    for relative_path, info in files:
+        with archive.open(info) as src, open(os.path.join(target_dir, relative_path), 'wb') as dst:
+            shutil.copyfileobj(src, dst, EXTRACT_BUFFER_SIZE)
+
 def install_mainsail():
     """Install Mainsail web interface"""
     log("Installing Mainsail web interface...")
     
-    # Step 1: Create directory and cd there
+    # Step 1: Create directory
     mainsail_dir = "/mnt/UDISK/root/mainsail"
     log(f"Preparing directory: {mainsail_dir}")
     
     try:
-        # If mainsail dir exists already, remove it to avoid unzip prompts/hangs
-        if os.path.exists(mainsail_dir):
-            log("Existing Mainsail directory found. Removing it before reinstall...")
+        # If mainsail dir exists already, remove it so no stale files survive the reinstall
+        try:
             shutil.rmtree(mainsail_dir)
+            log("Removed existing Mainsail directory before reinstall")
+        except FileNotFoundError:
+            pass
         os.makedirs(mainsail_dir, exist_ok=True)
-        os.chdir(mainsail_dir)
-        log(f"Changed to directory: {mainsail_dir}")
     except Exception as e:
-        log(f"Failed to create/change to directory: {e}", "ERROR")
+        log(f"Failed to create directory: {e}", "ERROR")
         return False
     
     # Step 2: Download and extract mainsail
-    # Prefer absolute paths for wget/unzip to avoid PATH issues on non-interactive shells
+    # Prefer absolute path for wget to avoid PATH issues on non-interactive shells
     wget_bin = "/opt/bin/wget" if os.path.exists("/opt/bin/wget") else "wget"
-    unzip_bin = "/opt/bin/unzip" if os.path.exists("/opt/bin/unzip") else "unzip"
 
-    log("Downloading Mainsail...")
-    download_command = f"{wget_bin} -q -O mainsail.zip https://github.com/mainsail-crew/mainsail/releases/latest/download/mainsail.zip"
-    result = run_command(download_command)
-    if not result or result.returncode != 0:
-        log("Failed to download Mainsail", "ERROR")
-        return False
-    
-    log("Extracting Mainsail...")
-    # -o overwrite without prompting, -q quiet to reduce noise in logs
-    extract_command = f"{unzip_bin} -o -q mainsail.zip"
-    result = run_command(extract_command)
-    if not result or result.returncode != 0:
-        log("Failed to extract Mainsail", "ERROR")
-        return False
-    
-    log("Cleaning up zip file...")
-    cleanup_command = "rm mainsail.zip"
-    result = run_command(cleanup_command)
-    if not result or result.returncode != 0:
-        log("Failed to remove zip file", "ERROR")
-        return False
+    # Stream the release from wget's stdout into memory (only spilling to a temp file if it is
+    # unexpectedly large) and extract it from there, so the zip itself is never written to flash
+    with tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE) as zip_buffer:
+        log("Downloading Mainsail...")
+        try:
+            process = subprocess.Popen([wget_bin, "-q", "-O", "-", MAINSAIL_RELEASE_URL],
+                                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            with process.stdout:
+                shutil.copyfileobj(process.stdout, zip_buffer)
+            return_code = process.wait()
+        except Exception as e:
+            log(f"Failed to download Mainsail: {e}", "ERROR")
+            return False
+        if return_code != 0:
+            log("Failed to download Mainsail", "ERROR")
+            return False
+        
+        log("Extracting Mainsail...")
+        try:
+            with zipfile.ZipFile(zip_buffer) as archive:
+                extract_zip(archive, mainsail_dir)
+        except Exception as e:
+            log(f"Failed to extract Mainsail: {e}", "ERROR")
+            return False
     
     # Step 3: Create symlink to /usr/share/
     log("Creating symlink to /usr/share/mainsail...")
     
-    # Remove existing symlink if it exists
+    # A real directory cannot be replaced by a symlink, so remove it first
     usr_share_mainsail = "/usr/share/mainsail"
-    if os.path.exists(usr_share_mainsail):
-        if os.path.islink(usr_share_mainsail):
-            os.unlink(usr_share_mainsail)
-            log("Removed existing symlink")
-        else:
-            shutil.rmtree(usr_share_mainsail)
-            log("Removed existing directory")
+    if os.path.isdir(usr_share_mainsail) and not os.path.islink(usr_share_mainsail):
+        shutil.rmtree(usr_share_mainsail)
+        log("Removed existing directory")
     
-    # Create new symlink
+    # Create the new symlink beside the old one and rename it over it, so the path always resolves
+    tmp_link = usr_share_mainsail + ".new"
     try:
-        os.symlink(mainsail_dir, usr_share_mainsail)
+        try:
+            os.unlink(tmp_link)
+        except FileNotFoundError:
+            pass
+        os.symlink(mainsail_dir, tmp_link)
+        os.replace(tmp_link, usr_share_mainsail)
         log("Created symlink from /mnt/UDISK/root/mainsail to /usr/share/mainsail")
     except Exception as e:
         log(f"Failed to create symlink: {e}", "ERROR")
@@ -98,52 +139,62 @@ def install_mainsail():
     nginx_conf_src = REPO_ROOT / "patches" / "nginx.conf"
     nginx_conf_dst = "/etc/nginx/nginx.conf"
     
-    if not check_file_exists(nginx_conf_src):
-        log(f"Source nginx config not found: {nginx_conf_src}", "ERROR")
-        return False
-    
+    # Copy to a temp file and rename it into place, so nginx never sees a half-written config
+    nginx_conf_tmp = nginx_conf_dst + ".tmp"
     try:
-        shutil.copy2(nginx_conf_src, nginx_conf_dst)
+        shutil.copyfile(nginx_conf_src, nginx_conf_tmp)
+        os.replace(nginx_conf_tmp, nginx_conf_dst)
         log("Replaced /etc/nginx/nginx.conf")
     except Exception as e:
-        log(f"Failed to replace nginx config: {e}", "ERROR")
+        if isinstance(e, FileNotFoundError) and e.filename == os.fspath(nginx_conf_src):
+            log(f"Source nginx config not found: {nginx_conf_src}", "ERROR")
+        else:
+            log(f"Failed to replace nginx config: {e}", "ERROR")
+        try:
+            os.remove(nginx_conf_tmp)
+        except FileNotFoundError:
+            pass
         return False
     
     # Step 4.5: Add update manager to moonraker.conf
     log("Adding Mainsail update manager to moonraker.conf...")
     moonraker_conf = "/mnt/UDISK/printer_data/config/moonraker.conf"
     
-    if not check_file_exists(moonraker_conf):
+    # Check and append through one handle instead of re-writing the whole file
+    try:
+        f = open(moonraker_conf, 'r+b')
+    except FileNotFoundError:
         log("moonraker.conf not found - cannot add update manager", "ERROR")
         return False
     
-    with open(moonraker_conf, 'r') as f:
+    with f:
         content = f.read()
         
-    if '[update_manager mainsail]' in content:
-        log("[update_manager mainsail] already exists in moonraker.conf")
-    else:
-        # Add the update manager section
-        # Ensure file ends with a newline before appending
-        if not content.endswith('\n'):
-            content += '\n'
-        content += '[update_manager mainsail]\n'
-        content += 'type: web\n'
-        content += 'channel: stable\n'
-        content += 'repo: mainsail-crew/mainsail\n'
-        content += 'path: ~root/mainsail\n'
+        if UPDATE_MANAGER_SECTION_RE.search(content):
+            log("[update_manager mainsail] already exists in moonraker.conf")
+        else:
+            # Add the update manager section
+            # Ensure file ends with a newline before appending
+            section = b'\n' if not content.endswith(b'\n') else b''
+            section += b'[update_manager mainsail]\n'
+            section += b'type: web\n'
+            section += b'channel: stable\n'
+            section += b'repo: mainsail-crew/mainsail\n'
+            section += b'path: ~root/mainsail\n'
             
-        # Write back to file
-        with open(moonraker_conf, 'w') as f:
-            f.write(content)
-        log("Added [update_manager mainsail] section to moonraker.conf")
+            # Append to the end of the file
+            f.seek(0, os.SEEK_END)
+            f.write(section)
+            log("Added [update_manager mainsail] section to moonraker.conf")
     
     # Step 5: Restart nginx
     log("Restarting nginx...")
-    restart_command = "/etc/init.d/nginx restart"
+    restart_command = ["/etc/init.d/nginx", "restart"]
     result = run_command(restart_command)
     if not result or result.returncode != 0:
         log("Failed to restart nginx", "ERROR")
+        if result and result.stderr:
+            log(result.stderr.strip(), "ERROR")
         return False
     
     log("Mainsail installation completed successfully")
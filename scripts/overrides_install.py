@@ -3,6 +3,7 @@
 import os
 import sys
 import shutil
+import tempfile
 import argparse
 from pathlib import Path
 import re
@@ -12,17 +13,25 @@ REPO_ROOT = Path(__file__).parent.parent.absolute()
 CONFIG_DIR = "/mnt/UDISK/printer_data/config"
 CUSTOM_CONFIG_DIR = "/mnt/UDISK/printer_data/config/custom"
 
+# Config files installed into the custom directory: (source, destination, label)
+CUSTOM_CONFIG_FILES = tuple(
+    (REPO_ROOT / "configs" / name, Path(CUSTOM_CONFIG_DIR) / name, name)
+    for name in ("macros.cfg", "start_print.cfg", "overrides.cfg")
+)
+
+# Our include lines in custom/main.cfg, wherever they currently are
+INCLUDE_LINE_PATTERN = re.compile(r"^\s*\[include\s+(macros\.cfg|start_print\.cfg|overrides\.cfg)\s*\]\s*$", re.MULTILINE)
+# Runs of blank lines left behind after removing includes
+BLANK_LINES_PATTERN = re.compile(r"\n{3,}")
+# move_check_distance already registered with minval=1
+MINVAL_OK_PATTERN = re.compile(r"['\"]move_check_distance['\"]\s*,\s*5(?:\.0*)?\s*,\s*minval\s*=\s*1(?:\.0*)?")
+# move_check_distance with any minval, capturing everything up to the value
+MINVAL_PATTERN = re.compile(r"(?P<prefix>['\"]move_check_distance['\"]\s*,\s*5(?:\.0*)?\s*,\s*minval\s*=\s*)(?P<val>[0-9]+(?:\.[0-9]*)?)")
+
 def log(message, level="INFO"):
     print(f"[{level}] {message}")
 
-def check_file_exists(path):
-    return os.path.exists(path)
-
 def copy_file(src, dst):
-    if not check_file_exists(src):
-        log(f"Source file not found: {src}", "ERROR")
-        return False
-        
     try:
         # If destination is a symlink, remove it so we replace with a regular file
         if os.path.islink(dst):
@@ -32,13 +41,39 @@ def copy_file(src, dst):
             except Exception as e:
                 log(f"Failed to remove existing symlink {dst}: {e}", "ERROR")
                 return False
-        shutil.copy2(src, dst)
+        # Just try the copy; a missing source shows up as FileNotFoundError naming it
+        shutil.copyfile(src, dst)
         log(f"Successfully copied {src} to {dst}")
         return True
+    except FileNotFoundError as e:
+        if e.filename == os.fspath(src):
+            log(f"Source file not found: {src}", "ERROR")
+        else:
+            log(f"Failed to copy {src}: {e}", "ERROR")
+        return False
     except Exception as e:
         log(f"Failed to copy {src}: {e}", "ERROR")
         return False
 
+def atomic_write(path, content):
+    """Write content to a temp file next to path, then swap it into place so path is never left truncated"""
+    path = os.path.realpath(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with open(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            shutil.copymode(path, tmp_path)
+        except FileNotFoundError:
+            # New file: give it the usual mode rather than mkstemp's 0600
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
 def install_overrides():
     """Install overrides.cfg to custom config directory"""
     log("Installing overrides.cfg...")
@@ -60,14 +95,8 @@ def install_custom_configs():
     # Ensure custom directory exists
     os.makedirs(CUSTOM_CONFIG_DIR, exist_ok=True)
 
-    install_map = [
-        (REPO_ROOT / "configs" / "macros.cfg", Path(CUSTOM_CONFIG_DIR) / "macros.cfg", "macros.cfg"),
-        (REPO_ROOT / "configs" / "start_print.cfg", Path(CUSTOM_CONFIG_DIR) / "start_print.cfg", "start_print.cfg"),
-        (REPO_ROOT / "configs" / "overrides.cfg", Path(CUSTOM_CONFIG_DIR) / "overrides.cfg", "overrides.cfg"),
-    ]
-
     all_ok = True
-    for src, dst, label in install_map:
+    for src, dst, label in CUSTOM_CONFIG_FILES:
         log(f"Installing {label}...")
         ok = copy_file(src, dst)
         all_ok = all_ok and ok
@@ -90,21 +119,19 @@ def update_custom_main_cfg(dry_run: bool = False) -> bool:
     ]
 
     # If file doesn't exist, create it with only our includes
-    if not check_file_exists(main_cfg_path):
+    try:
+        with open(main_cfg_path, "r", encoding="utf-8") as f:
+            content = f.read()
+    except FileNotFoundError:
         content = ""
-    else:
-        try:
-            with open(main_cfg_path, "r", encoding="utf-8") as f:
-                content = f.read()
-        except Exception as e:
-            log(f"Failed to read {main_cfg_path}: {e}", "ERROR")
-            return False
+    except Exception as e:
+        log(f"Failed to read {main_cfg_path}: {e}", "ERROR")
+        return False
 
     # Remove any existing occurrences of our include lines (dedupe/reorder)
-    include_regex = re.compile(r"^\s*\[include\s+(macros\.cfg|start_print\.cfg|overrides\.cfg)\s*\]\s*$", re.MULTILINE)
-    cleaned_content = re.sub(include_regex, "", content)
+    cleaned_content = INCLUDE_LINE_PATTERN.sub("", content)
     # Also trim excessive blank lines caused by removals
-    cleaned_content = re.sub(r"\n{3,}", "\n\n", cleaned_content)
+    cleaned_content = BLANK_LINES_PATTERN.sub("\n\n", cleaned_content)
 
     new_block = "\n".join(desired_includes) + "\n"
 
@@ -126,8 +153,7 @@ def update_custom_main_cfg(dry_run: bool = False) -> bool:
         return True
 
     try:
-        with open(main_cfg_path, "w", encoding="utf-8") as f:
-            f.write(new_content)
+        atomic_write(main_cfg_path, new_content)
         log("Updated custom/main.cfg with ordered includes for macros, start_print, and overrides")
         return True
     except Exception as e:
@@ -136,64 +162,89 @@ def update_custom_main_cfg(dry_run: bool = False) -> bool:
 
 def backup_file(file_path: str) -> str:
     """Create a simple .bak backup of the given file and return the backup path, or empty string on failure."""
+    backup_path = f"{file_path}.bak"
     try:
-        backup_path = f"{file_path}.bak"
-        if os.path.exists(backup_path):
-            log(f"Backup already exists, skipping: {backup_path}")
-            return backup_path
-        shutil.copy2(file_path, backup_path)
+        try:
+            # A hard link keeps the current version without copying any data. The file must then be
+            # updated by renaming a new file over it, never rewritten in place, or the backup changes too.
+            os.link(file_path, backup_path)
+        except (FileExistsError, FileNotFoundError):
+            raise
+        except OSError:
+            # Filesystem without hard links: copy instead, with an exclusive create
+            with open(file_path, "rb") as src, open(backup_path, "xb") as dst:
+                shutil.copyfileobj(src, dst)
+            shutil.copystat(file_path, backup_path)
         log(f"Created backup: {backup_path}")
         return backup_path
+    except FileExistsError:
+        log(f"Backup already exists, skipping: {backup_path}")
+        return backup_path
     except Exception as e:
         log(f"Failed to create backup for {file_path}: {e}", "ERROR")
         return ""
 
+def match_move_check_distance(pattern, content):
+    """Try pattern only where a quoted move_check_distance starts, returning the first match or None."""
+    index = content.find("move_check_distance", 1)
+    while index != -1:
+        match = pattern.match(content, index - 1)
+        if match:
+            return match
+        index = content.find("move_check_distance", index + 1)
+    return None
+
 def update_bed_mesh_minval(dry_run: bool = False) -> bool:
     """Ensure bed_mesh.py uses minval=1 for the 'move_check_distance' option."""
     target_file = "/usr/share/klipper/klippy/extras/bed_mesh.py"
 
-    if not check_file_exists(target_file):
-        log(f"Target file not found: {target_file}", "ERROR")
-        return False
-
     try:
         with open(target_file, "r", encoding="utf-8") as f:
             content = f.read()
+    except FileNotFoundError:
+        log(f"Target file not found: {target_file}", "ERROR")
+        return False
     except Exception as e:
         log(f"Failed to read {target_file}: {e}", "ERROR")
         return False
 
+    # Neither pattern can match without the option name, so rule that out with a plain substring test
+    if "move_check_distance" not in content:
+        if dry_run:
+            log("DRY RUN: Target pattern not found in bed_mesh.py; no changes would be made", "ERROR")
+        else:
+            log("Target pattern not found in bed_mesh.py; no changes made", "ERROR")
+        return False
+
     # Detect if already set to 1
-    already_ok = re.search(r"['\"]move_check_distance['\"]\s*,\s*5(?:\.0*)?\s*,\s*minval\s*=\s*1(?:\.0*)?", content)
+    already_ok = match_move_check_distance(MINVAL_OK_PATTERN, content)
     if already_ok:
         log("bed_mesh.py already has minval=1 for 'move_check_distance'; no change needed")
         return True
 
-    # Pattern to capture the prefix up to the numeric value of minval
-    pattern = r"(?P<prefix>['\"]move_check_distance['\"]\s*,\s*5(?:\.0*)?\s*,\s*minval\s*=\s*)(?P<val>[0-9]+(?:\.[0-9]*)?)"
-
+    minval_match = match_move_check_distance(MINVAL_PATTERN, content)
     if dry_run:
-        if re.search(pattern, content):
+        if minval_match:
             log(f"DRY RUN: Would update minval to 1 in {target_file}")
             return True
         else:
             log("DRY RUN: Target pattern not found in bed_mesh.py; no changes would be made", "ERROR")
             return False
 
-    # Perform the replacement once
-    new_content, num_subs = re.subn(pattern, r"\g<prefix>1", content, count=1)
-    if num_subs == 0:
+    # Perform the replacement once, splicing 1 in place of the matched value
+    if not minval_match:
         log("Target pattern not found in bed_mesh.py; no changes made", "ERROR")
         return False
+    new_content = content[:minval_match.start("val")] + "1" + content[minval_match.end("val"):]
 
     # Backup before writing
     if not backup_file(target_file):
         log("Backup failed; aborting update to prevent data loss", "ERROR")
         return False
 
+    # Rename the new version into place rather than rewriting the file, so the hard-linked backup keeps the old inode
     try:
-        with open(target_file, "w", encoding="utf-8") as f:
-            f.write(new_content)
+        atomic_write(target_file, new_content)
         log("Updated bed_mesh.py: set minval=1 for 'move_check_distance'")
         return True
     except Exception as e:
@@ -13,21 +13,21 @@ KLIPPER_EXTRAS_DIR = "/usr/share/klipper/klippy/extras"
 def log(message, level="INFO"):
     print(f"[{level}] {message}")
 
-def check_file_exists(path):
-    return os.path.exists(path)
-
 def copy_file(src, dst):
-    if not check_file_exists(src):
-        log(f"Source file not found: {src}", "ERROR")
-        return False
-        
+    # Just try the copy; a missing source shows up as FileNotFoundError naming it
     try:
-        shutil.copy2(src, dst)
-        log(f"Successfully copied {src} to {dst}")
-        return True
+        shutil.copyfile(src, dst)
+    except FileNotFoundError as e:
+        if e.filename == os.fspath(src):
+            log(f"Source file not found: {src}", "ERROR")
+        else:
+            log(f"Failed to copy {src}: {e}", "ERROR")
+        return False
     except Exception as e:
         log(f"Failed to copy {src}: {e}", "ERROR")
         return False
+    log(f"Successfully copied {src} to {dst}")
+    return True
 
 def install_resonance_tester():
     """Install the custom resonance tester"""
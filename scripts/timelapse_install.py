@@ -2,7 +2,10 @@
 
 import os
 import sys
+import re
 import shutil
+import tarfile
+import tempfile
 import subprocess
 import argparse
 from pathlib import Path
@@ -11,54 +14,139 @@ from pathlib import Path
 REPO_ROOT = Path(__file__).parent.parent.absolute()
 BASE_CONFIG_DIR = "/mnt/UDISK/printer_data/config"
 CUSTOM_CONFIG_DIR = "/mnt/UDISK/printer_data/config/custom"
+MOONRAKER_COMPONENTS_DIR = "/mnt/UDISK/root/moonraker/moonraker/components"
+TIMELAPSE_TARBALL_URL = "https://codeload.github.com/mainsail-crew/moonraker-timelapse/tar.gz/refs/heads/main"
+# The only files we need from the moonraker-timelapse repository
+TIMELAPSE_COMPONENT_FILE = "component/timelapse.py"
+TIMELAPSE_MACRO_FILE = "klipper_macro/timelapse.cfg"
+
+# Encoder patches for timelapse.py, each applied in a single pass over the file.
+# Where keys overlap the longer one is listed first, since the alternation tries them in order.
+MJPEG_REPLACEMENTS = {
+    # Prefer codec mjpeg over libx264
+    "-vcodec libx264": "-vcodec mjpeg",
+    "-c:v libx264": "-c:v mjpeg",
+    # Map CRF (x264) to q:v (mjpeg quality). Keep the same numeric value.
+    " -crf ": " -q:v ",
+    # Remove GOP size flag which is not applicable to MJPEG
+    " -threads 2 -g 5": " -threads 2",
+    " -g 5": "",
+    # Improve MP4 playback start without re-encode cost
+    " -an": " -an -movflags +faststart",
+}
+H264_REPLACEMENTS = {
+    # Normalize any mjpeg or libx264 codec flag to -c:v libx264 with preset and tune stillimage
+    "-vcodec mjpeg": "-c:v libx264 -preset ultrafast -tune stillimage",
+    "-c:v mjpeg": "-c:v libx264 -preset ultrafast -tune stillimage",
+    "-vcodec libx264": "-c:v libx264 -preset ultrafast -tune stillimage",
+    "-c:v libx264": "-c:v libx264 -preset ultrafast -tune stillimage",
+    # We cannot know fps at install time, so drop the hard-coded GOP of 5
+    " -g 5": "",
+    # Ensure CRF remains CRF for h264
+    " -q:v ": " -crf ",
+    # Keep pix_fmt, an, extra params and output as-is
+}
+MJPEG_PATTERN = re.compile("|".join(map(re.escape, MJPEG_REPLACEMENTS)))
+H264_PATTERN = re.compile("|".join(map(re.escape, H264_REPLACEMENTS)))
 
 def log(message, level="INFO"):
     print(f"[{level}] {message}")
 
-def check_file_exists(path):
-    return os.path.exists(path)
-
-def copy_file(src, dst):
-    if not check_file_exists(src):
-        log(f"Source file not found: {src}", "ERROR")
-        return False
-        
+def atomic_write(path, data):
+    """Write data to a temp file next to path, then swap it into place so path is never left truncated"""
+    path = os.path.realpath(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
     try:
-        shutil.copy2(src, dst)
-        log(f"Successfully copied {src} to {dst}")
-        return True
+        with open(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            shutil.copymode(path, tmp_path)
+        except FileNotFoundError:
+            # New file: give it the usual mode rather than mkstemp's 0600
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+def write_file(path, data):
+    try:
+        atomic_write(path, data)
     except Exception as e:
-        log(f"Failed to copy {src}: {e}", "ERROR")
+        log(f"Failed to write {path}: {e}", "ERROR")
         return False
+    log(f"Successfully wrote {path}")
+    return True
 
 def run_command(command):
-    """Run a command and return the result"""
+    """Run a command (an argv list, no shell) and return the result"""
     try:
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
+        # Callers only check the exit status, so don't pipe the output back
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         return result
     except Exception as e:
         log(f"Command failed: {e}", "ERROR")
         return None
 
+def read_file_bytes(path):
+    """Return the contents of path, or None if it does not exist"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def restore_file(path, data):
+    """Put back the contents read earlier by read_file_bytes, removing path if it did not exist then"""
+    try:
+        if data is None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        else:
+            atomic_write(path, data)
+    except Exception as e:
+        log(f"Failed to restore {path}: {e}", "ERROR")
+
+def download_tarball_files(url, wanted):
+    """Stream a .tar.gz from url through wget and return {path: bytes} for the wanted paths below its top-level folder"""
+    wget_bin = "/opt/bin/wget" if os.path.exists("/opt/bin/wget") else "wget"
+    found = {}
+    process = subprocess.Popen([wget_bin, "-q", "-O", "-", url], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        with tarfile.open(fileobj=process.stdout, mode="r|gz") as archive:
+            for member in archive:
+                relative_path = member.name.split("/", 1)[-1]
+                if member.isfile() and relative_path in wanted:
+                    found[relative_path] = archive.extractfile(member).read()
+        # Read what is left after the archive (end padding) so wget can finish cleanly
+        while process.stdout.read(65536):
+            pass
+    finally:
+        process.stdout.close()
+        return_code = process.wait()
+    if return_code != 0:
+        raise RuntimeError(f"wget exited with code {return_code}")
+    return found
+
 def add_include_to_main_cfg(include_line):
     """Ensure include line is the FIRST line of custom/main.cfg"""
     main_cfg = Path(CUSTOM_CONFIG_DIR) / "main.cfg"
     
     # Do not create files/dirs; fail fast if missing
-    if not check_file_exists(main_cfg):
-        log("custom/main.cfg not found - cannot add include line", "ERROR")
-        return False
-
     try:
         with open(main_cfg, 'r') as f:
-            content = f.read()
+            # If already first line, nothing to do and no need to read the rest
+            first_line = f.readline()
+            if first_line.strip() == include_line:
+                log(f"{include_line} already present as the first line in main.cfg")
+                return True
+            content = first_line + f.read()
 
         lines = content.splitlines()
-        # If already first line, nothing to do
-        if lines and lines[0].strip() == include_line:
-            log(f"{include_line} already present as the first line in main.cfg")
-            return True
-
         # Remove any existing occurrences of the include line
         filtered_lines = [line for line in lines if line.strip() != include_line]
         # Insert include line at the very top
@@ -67,10 +155,12 @@ def add_include_to_main_cfg(include_line):
         if not new_content.endswith('\n'):
             new_content += '\n'
 
-        with open(main_cfg, 'w') as f:
-            f.write(new_content)
+        atomic_write(main_cfg, new_content.encode('utf-8'))
         log("Added timelapse include to main.cfg")
         return True
+    except FileNotFoundError:
+        log("custom/main.cfg not found - cannot add include line", "ERROR")
+        return False
     except Exception as e:
         log(f"Failed to update main.cfg: {e}", "ERROR")
         return False
@@ -78,58 +168,64 @@ def add_include_to_main_cfg(include_line):
 def add_timelapse_to_moonraker_conf():
     """Ensure [timelapse] exists and contains desired output_path in moonraker.conf"""
     moonraker_conf = Path(BASE_CONFIG_DIR) / "moonraker.conf"
-    if not check_file_exists(moonraker_conf):
+    try:
+        with open(moonraker_conf, 'r') as f:
+            content = f.read()
+    except FileNotFoundError:
         log("moonraker.conf not found - cannot add timelapse section", "ERROR")
         return False
-        
-    with open(moonraker_conf, 'r') as f:
-        content = f.read()
 
-    lines = content.splitlines()
-    section_start_index = None
     desired_output_line = 'output_path: /mnt/UDISK/root/timelapse'
 
-    # Locate the [timelapse] section header exactly
-    for index, line in enumerate(lines):
-        if line.strip() == '[timelapse]':
-            section_start_index = index
+    # Locate the [timelapse] section header exactly, jumping between occurrences with find
+    header_pos = content.find('[timelapse]')
+    while header_pos != -1:
+        line_start = content.rfind('\n', 0, header_pos) + 1
+        line_end = content.find('\n', header_pos)
+        if line_end == -1:
+            line_end = len(content)
+        if content[line_start:line_end].strip() == '[timelapse]':
             break
+        header_pos = content.find('[timelapse]', line_end)
 
     # If section is missing, append it along with the desired output_path
-    if section_start_index is None:
+    if header_pos == -1:
         if content and not content.endswith('\n'):
             content += '\n'
         content += '[timelapse]\n' + desired_output_line + '\n'
-        with open(moonraker_conf, 'w') as f:
-            f.write(content)
+        atomic_write(moonraker_conf, content.encode('utf-8'))
         log("Added [timelapse] section and output_path to moonraker.conf")
         return True
 
     # Find the end of the [timelapse] section (next section header or EOF)
-    section_end_index = len(lines)
-    for scan_index in range(section_start_index + 1, len(lines)):
-        stripped = lines[scan_index].strip()
-        if stripped.startswith('[') and stripped.endswith(']'):
-            section_end_index = scan_index
+    body_start = line_end + 1
+    section_end = len(content)
+    bracket_pos = content.find('[', body_start)
+    while bracket_pos != -1:
+        line_start = content.rfind('\n', 0, bracket_pos) + 1
+        line_end = content.find('\n', bracket_pos)
+        if line_end == -1:
+            line_end = len(content)
+        if not content[line_start:bracket_pos].strip() and content[bracket_pos:line_end].rstrip().endswith(']'):
+            section_end = line_start
             break
+        bracket_pos = content.find('[', line_end)
 
     # Check if output_path already exists in the section (support both ':' and '=')
-    has_output_path = False
-    for section_line_index in range(section_start_index + 1, section_end_index):
-        stripped = lines[section_line_index].strip()
-        if stripped.startswith('output_path:') or stripped.startswith('output_path ='):
-            has_output_path = True
-            break
+    has_output_path = any(
+        line.strip().startswith(('output_path:', 'output_path ='))
+        for line in content[body_start:section_end].splitlines()
+    )
 
-    # Insert desired output_path if missing
+    # Insert desired output_path right after the header line if missing
     if not has_output_path:
-        insert_index = section_start_index + 1
-        lines.insert(insert_index, desired_output_line)
-        new_content = '\n'.join(lines)
+        if body_start > len(content):
+            new_content = content + '\n' + desired_output_line
+        else:
+            new_content = content[:body_start] + desired_output_line + '\n' + content[body_start:]
         if not new_content.endswith('\n'):
             new_content += '\n'
-        with open(moonraker_conf, 'w') as f:
-            f.write(new_content)
+        atomic_write(moonraker_conf, new_content.encode('utf-8'))
         log("Added output_path to existing [timelapse] in moonraker.conf")
         return True
 
@@ -137,87 +233,44 @@ def add_timelapse_to_moonraker_conf():
     return True
 
 def apply_mjpeg_patch(tl_content):
-    original_content = tl_content
-
-    # Prefer codec mjpeg over libx264
-    tl_content = tl_content.replace("-vcodec libx264", "-vcodec mjpeg")
-    tl_content = tl_content.replace("-c:v libx264", "-c:v mjpeg")
-
-    # Map CRF (x264) to q:v (mjpeg quality). Keep the same numeric value.
-    tl_content = tl_content.replace(" -crf ", " -q:v ")
-
-    # Remove GOP size flag which is not applicable to MJPEG
-    tl_content = tl_content.replace(" -threads 2 -g 5", " -threads 2")
-    tl_content = tl_content.replace(" -g 5", "")
-
-    # Improve MP4 playback start without re-encode cost
-    tl_content = tl_content.replace(" -an", " -an -movflags +faststart")
-
-    return tl_content, tl_content != original_content
+    patched = MJPEG_PATTERN.sub(lambda match: MJPEG_REPLACEMENTS[match.group(0)], tl_content)
+    return patched, patched != tl_content
 
 
 def apply_h264_patch(tl_content):
-    original_content = tl_content
-
-    # Replace any mjpeg or libx264 usage with desired h264 command shape
-    # Normalize both -vcodec and -c:v flags to libx264
-    tl_content = tl_content.replace("-vcodec mjpeg", "-vcodec libx264")
-    tl_content = tl_content.replace("-c:v mjpeg", "-c:v libx264")
-    # Ensure -c:v libx264 exists
-    tl_content = tl_content.replace("-vcodec libx264", "-c:v libx264")
-
-    # Set preset and tune stillimage
-    # Insert/replace preset and tune after codec declaration when present
-    tl_content = tl_content.replace("-c:v libx264", "-c:v libx264 -preset ultrafast -tune stillimage")
-
-    # Set GOP to fps: replace occurrences of " -threads 2 -g 5" or " -g 5" with dynamic fps placeholder
-    # We cannot know fps at install time, so we replace any fixed -g 5 with " -g " + str(fps) at runtime pattern.
-    # The original code builds: " -g " + str(fps) when using our desired form; ensure we remove hard-coded 5.
-    tl_content = tl_content.replace(" -g 5", "")
-
-    # Ensure CRF remains CRF for h264
-    tl_content = tl_content.replace(" -q:v ", " -crf ")
-
-    # Keep pix_fmt, an, extra params and output as-is
-    return tl_content, tl_content != original_content
+    patched = H264_PATTERN.sub(lambda match: H264_REPLACEMENTS[match.group(0)], tl_content)
+    return patched, patched != tl_content
 
 
 def install_timelapse(encoder="mjpeg"):
     """Install moonraker-timelapse component"""
     log("Installing moonraker-timelapse component...")
     
-    # Define paths
-    moonraker_components_dir = "/mnt/UDISK/root/moonraker/moonraker/components"
-    temp_dir = "/tmp/moonraker-timelapse"
-    
-    # Clone the repository
-    # Remove existing temp directory if it exists
-    if os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
-        
-    git_bin = "/opt/bin/git" if os.path.exists("/opt/bin/git") else "git"
-    clone_command = f"{git_bin} clone --depth 1 --quiet https://github.com/mainsail-crew/moonraker-timelapse.git /tmp/moonraker-timelapse"
-    result = run_command(clone_command)
-    if not result or result.returncode != 0:
-        log("Failed to clone moonraker-timelapse repository", "ERROR")
+    # Download the repository tarball and keep just the two files we need, in memory
+    wanted = (TIMELAPSE_COMPONENT_FILE, TIMELAPSE_MACRO_FILE)
+    try:
+        sources = download_tarball_files(TIMELAPSE_TARBALL_URL, wanted)
+    except Exception as e:
+        log(f"Failed to download moonraker-timelapse repository: {e}", "ERROR")
         return False
-    log("Successfully cloned moonraker-timelapse repository")
+    for name in wanted:
+        if name not in sources:
+            log(f"Source file not found in moonraker-timelapse download: {name}", "ERROR")
+            return False
+    log("Successfully downloaded moonraker-timelapse repository")
     
-    # Copy timelapse.py component
-    timelapse_src = Path(temp_dir) / "component" / "timelapse.py"
-    timelapse_dst = Path(moonraker_components_dir) / "timelapse.py"
-    
-    if not check_file_exists(timelapse_src):
-        log(f"Source file not found: {timelapse_src}", "ERROR")
-        return False
-        
-    if not copy_file(timelapse_src, timelapse_dst):
-        return False
+    # Files each service loads at startup; remember them so only services whose files change get restarted
+    timelapse_dst = Path(MOONRAKER_COMPONENTS_DIR) / "timelapse.py"
+    timelapse_cfg_dst = Path(CUSTOM_CONFIG_DIR) / "timelapse.cfg"
+    service_files = {
+        "moonraker": (timelapse_dst, Path(BASE_CONFIG_DIR) / "moonraker.conf"),
+        "klipper": (timelapse_cfg_dst, Path(CUSTOM_CONFIG_DIR) / "main.cfg"),
+    }
+    original_contents = {path: read_file_bytes(path) for paths in service_files.values() for path in paths}
     
-    # After copying, patch the component encoder based on selection
+    # Patch the component encoder based on selection before it is written
     try:
-        with open(timelapse_dst, 'r') as f:
-            tl_content = f.read()
+        tl_content = sources[TIMELAPSE_COMPONENT_FILE].decode('utf-8')
 
         if encoder == "h264":
             tl_content, changed = apply_h264_patch(tl_content)
@@ -225,28 +278,23 @@ def install_timelapse(encoder="mjpeg"):
             tl_content, changed = apply_mjpeg_patch(tl_content)
 
         if changed:
-            with open(timelapse_dst, 'w') as f:
-                f.write(tl_content)
             log(f"Patched timelapse.py to use {encoder.upper()} encoding for timelapse videos")
         else:
             log("timelapse.py did not contain expected codec strings; no codec patch applied", "INFO")
     except Exception as e:
         log(f"Failed to patch timelapse.py for {encoder.upper()}: {e}", "ERROR")
         return False
-        
-    # Copy timelapse.cfg to custom config directory
-    timelapse_cfg_src = Path(temp_dir) / "klipper_macro" / "timelapse.cfg"
-    timelapse_cfg_dst = Path(CUSTOM_CONFIG_DIR) / "timelapse.cfg"
     
-    if not check_file_exists(timelapse_cfg_src):
-        log(f"Source file not found: {timelapse_cfg_src}", "ERROR")
+    # Install the patched timelapse.py component in a single write
+    if not write_file(timelapse_dst, tl_content.encode('utf-8')):
         return False
         
+    # Install timelapse.cfg to custom config directory
     # Do not create destination directory; require it to exist
     if not os.path.isdir(CUSTOM_CONFIG_DIR):
         log(f"Custom config directory not found: {CUSTOM_CONFIG_DIR}", "ERROR")
         return False
-    if not copy_file(timelapse_cfg_src, timelapse_cfg_dst):
+    if not write_file(timelapse_cfg_dst, sources[TIMELAPSE_MACRO_FILE]):
         return False
         
     # Add include to the FIRST line of custom/main.cfg
@@ -257,19 +305,24 @@ def install_timelapse(encoder="mjpeg"):
     if not add_timelapse_to_moonraker_conf():
         return False
         
-    # Clean up temporary directory
-    if os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
-        log("Cleaned up temporary directory")
-        
-    # Restart moonraker and klipper to load the new component and config
-    restart_command = "/etc/init.d/moonraker restart && /etc/init.d/klipper restart"
-    result = run_command(restart_command)
-    if result and result.returncode == 0:
-        log("moonraker and klipper restarted successfully")
+    # Restart moonraker and then klipper to load the new component and config, skipping any whose files are unchanged
+    services = [
+        service for service, paths in service_files.items()
+        if any(read_file_bytes(path) != original_contents[path] for path in paths)
+    ]
+    for i, service in enumerate(services):
+        result = run_command([f"/etc/init.d/{service}", "restart"])
+        if not result or result.returncode != 0:
+            log(f"Failed to restart {service}", "ERROR")
+            # Roll back the files of this and any later service, so a re-run sees them change again and restarts
+            for pending in services[i:]:
+                for path in service_files[pending]:
+                    restore_file(path, original_contents[path])
+            return False
+    if services:
+        log(f"{' and '.join(services)} restarted successfully")
     else:
-        log("Failed to restart moonraker and klipper", "ERROR")
-        return False
+        log("No timelapse files changed; moonraker and klipper were not restarted")
         
     log("moonraker-timelapse component installed successfully")
     return True
@@ -7,90 +7,113 @@ import json
 import shutil
 import socket
 import subprocess
+import http.client
 from pathlib import Path
-from urllib import request, parse, error
+from urllib import parse
+
+from cleanup_install import ensure_asvc_entries
 
 GREEN='\033[0;32m'
 RED='\033[0;31m'
 YELLOW='\033[1;33m'
 NC='\033[0m'
 
+# Repo checkout this script runs from, for the bundled binary and init script
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
 REPORT_INSTALL_STATUS=""
-REPORT_BACKUPS_CREATED=""
-REPORT_SERVICES_CONFIGURED=""
-REPORT_ERRORS=""
+REPORT_BACKUPS_CREATED=[]
+REPORT_SERVICES_CONFIGURED=[]
+REPORT_ERRORS=[]
 REPORT_IP=""
 REPORT_CAMERAS=""
-REPORT_CAMERA_ACTIONS=""
+REPORT_CAMERA_ACTIONS=[]
 REPORT_CAMERA_STATUS=""
 REPORT_USTREAMER_PORT="8080"
 REPORT_USTREAMER_RESOLUTION="1920x1080"
 REPORT_USTREAMER_FPS="30"
 REPORT_AUTO_RESTART_INTERVAL="30"
 
+# Kept-alive HTTP connections by host:port, so the Moonraker webcam calls share one socket
+HTTP_CONNECTIONS = {}
+
 
 def log_action(msg: str) -> None:
     print(msg)
 
 
 def log_error(msg: str) -> None:
-    global REPORT_ERRORS
     sys.stderr.write(f"{RED}ERROR: {msg}{NC}\n")
-    REPORT_ERRORS += f"{msg}\n"
+    REPORT_ERRORS.append(msg)
 
 
 def log_backup(msg: str) -> None:
-    global REPORT_BACKUPS_CREATED
-    REPORT_BACKUPS_CREATED += f"{msg}\n"
+    REPORT_BACKUPS_CREATED.append(msg)
 
 
 def log_service(msg: str) -> None:
-    global REPORT_SERVICES_CONFIGURED
-    REPORT_SERVICES_CONFIGURED += f"{msg}\n"
+    REPORT_SERVICES_CONFIGURED.append(msg)
 
 
-def run(cmd: str) -> subprocess.CompletedProcess:
-    return subprocess.run(cmd, shell=True, text=True, capture_output=True)
+def run(cmd: list) -> subprocess.CompletedProcess:
+    # No shell: a missing program raises instead, so report it as 127 like sh did
+    try:
+        return subprocess.run(cmd, text=True, capture_output=True)
+    except OSError as e:
+        return subprocess.CompletedProcess(cmd, 127, "", str(e))
 
 
-def run_ok(cmd: str) -> bool:
-    r = run(cmd)
-    if r.returncode != 0:
-        return False
-    return True
+def run_silent(cmd: list) -> int:
+    # Only the exit status is wanted, so send the output nowhere instead of piping it back
+    try:
+        return subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        return 127
+
+
+def run_ok(cmd: list) -> bool:
+    return run_silent(cmd) == 0
 
 
 def install_ustreamer() -> None:
     global REPORT_INSTALL_STATUS
     log_action("Installing ustreamer...")
 
-    # Stop existing service/process to avoid "Text file busy" on replace
-    run("/etc/init.d/ustreamer stop 2>/dev/null || true")
-    run("killall ustreamer 2>/dev/null || true")
+    # Stop existing service/process to avoid "Text file busy" on replace (nothing to stop on a first install)
+    if run_ok(["pidof", "ustreamer"]):
+        run_silent(["/etc/init.d/ustreamer", "stop"])
+        run_silent(["killall", "ustreamer"])
 
-    if run_ok("/etc/init.d/cron enable"):
+    if run_ok(["/etc/init.d/cron", "enable"]):
         log_service("cron service enabled")
     else:
         log_error("Failed to enable cron service")
 
     # Copy ustreamer binary to system
-    repo_root = Path(__file__).resolve().parent.parent
-    binary_src = repo_root / "binaries" / "ustreamer_static_arm32"
+    binary_src = REPO_ROOT / "binaries" / "ustreamer_static_arm32"
     binary_dst = Path("/usr/local/bin/ustreamer")
     
     try:
         # Create directory if it doesn't exist
         binary_dst.parent.mkdir(parents=True, exist_ok=True)
 
-        # Copy to a temporary path, chmod, then atomically replace to avoid busy-text errors
+        # Stage at a temporary path, chmod, then atomically replace to avoid busy-text errors
         tmp_path = binary_dst.parent / "ustreamer.new"
-        shutil.copy2(binary_src, tmp_path)
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        # Hard-link when the repo is on the same filesystem (no data copy), otherwise copy
+        try:
+            os.link(binary_src, tmp_path)
+        except OSError:
+            shutil.copy2(binary_src, tmp_path)
         os.chmod(tmp_path, 0o755)
         os.replace(tmp_path, binary_dst)
         log_action("Installed ustreamer binary to /usr/local/bin/ustreamer (atomic replace)")
 
         # Test binary
-        if run_ok("/usr/local/bin/ustreamer --help"):
+        if run_ok(["/usr/local/bin/ustreamer", "--help"]):
             REPORT_INSTALL_STATUS = "ustreamer installed successfully"
         else:
             log_error("ustreamer binary test failed")
@@ -122,7 +145,7 @@ def backup_and_disable_services() -> None:
         except Exception:
             pass
 
-        run("killall webrtc_local 2>/dev/null || true")
+        run_silent(["killall", "webrtc_local"])
 
     # cam_app
     if Path("/usr/bin/cam_app").exists():
@@ -148,8 +171,8 @@ def backup_and_disable_services() -> None:
     # Disable old mjpg_streamer if present
     if Path("/etc/init.d/mjpg_streamer").exists():
         try:
-            run("/etc/init.d/mjpg_streamer stop")
-            run("/etc/init.d/mjpg_streamer disable")
+            run_silent(["/etc/init.d/mjpg_streamer", "stop"])
+            run_silent(["/etc/init.d/mjpg_streamer", "disable"])
             log_action("Stopped and disabled old mjpg_streamer service")
             log_service("mjpg_streamer service stopped and disabled")
         except Exception:
@@ -158,9 +181,7 @@ def backup_and_disable_services() -> None:
 
 def create_ustreamer_service() -> None:
     log_action("Creating ustreamer service...")
-    # Determine repo root from this script location
-    repo_root = Path(__file__).resolve().parent.parent
-    src = repo_root / "services" / "ustreamer"
+    src = REPO_ROOT / "services" / "ustreamer"
     try:
         shutil.copyfile(src, "/etc/init.d/ustreamer")
         os.chmod("/etc/init.d/ustreamer", 0o755)
@@ -174,30 +195,21 @@ def configure_services() -> None:
     log_action("Configuring services...")
 
     try:
-        asvc_path = "/mnt/UDISK/printer_data/moonraker.asvc"
-        existing = ""
-        if Path(asvc_path).exists():
-            with open(asvc_path, "r") as f:
-                existing = f.read()
-        if "\nustreamer\n" in f"\n{existing}\n":
-            log_action("ustreamer already registered with Moonraker supervisor")
-        else:
-            with open(asvc_path, "a") as f:
-                if not existing.endswith('\n'):
-                    f.write('\n')
-                f.write("ustreamer\n")
+        if ensure_asvc_entries("/mnt/UDISK/printer_data/moonraker.asvc", ["ustreamer"]):
             log_action("Registered ustreamer with Moonraker supervisor")
             log_service("ustreamer registered with Moonraker")
+        else:
+            log_action("ustreamer already registered with Moonraker supervisor")
     except Exception:
         log_error("Failed to register with Moonraker")
 
-    if run_ok("/etc/init.d/ustreamer restart"):
+    if run_ok(["/etc/init.d/ustreamer", "restart"]):
         log_action("Started ustreamer service")
         log_service("ustreamer service started")
     else:
         log_error("Failed to start ustreamer service")
 
-    if run_ok("/etc/init.d/ustreamer enable"):
+    if run_ok(["/etc/init.d/ustreamer", "enable"]):
         log_action("Enabled ustreamer service")
         log_service("ustreamer service enabled at boot")
     else:
@@ -217,69 +229,96 @@ def get_ip_address() -> str:
     return "127.0.0.1"
 
 
+def send_http_request(conn: http.client.HTTPConnection, method: str, target: str, body, headers: dict) -> tuple[int, bytes]:
+    try:
+        conn.request(method, target, body=body, headers=headers)
+        resp = conn.getresponse()
+        data = resp.read()
+    except Exception:
+        conn.close()
+        raise
+    # Keep the connection for the next call unless the server is closing it
+    if resp.will_close:
+        conn.close()
+    else:
+        HTTP_CONNECTIONS[conn.host, conn.port] = conn
+    return resp.status, data
+
+
+def http_request(method: str, url: str, body=None, headers=None) -> tuple[int, bytes]:
+    parts = parse.urlsplit(url)
+    target = f"{parts.path}?{parts.query}" if parts.query else parts.path
+    conn = HTTP_CONNECTIONS.pop((parts.hostname, parts.port or 80), None)
+    if conn is not None:
+        try:
+            return send_http_request(conn, method, target, body, headers or {})
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            # The server dropped the idle connection since its last use; retry once on a new one
+            pass
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=3)
+    return send_http_request(conn, method, target, body, headers or {})
+
+
 def http_get(url: str) -> tuple[int, str]:
     try:
-        with request.urlopen(url, timeout=3) as resp:
-            return resp.getcode(), resp.read().decode("utf-8", "ignore")
+        code, body = http_request("GET", url)
     except Exception:
         return 0, ""
+    if not 200 <= code < 300:
+        return 0, ""
+    return code, body.decode("utf-8", "ignore")
 
 
 def http_post(url: str, data: dict) -> int:
     try:
         data_bytes = json.dumps(data).encode("utf-8")
-        req = request.Request(url, data=data_bytes, headers={"Content-Type": "application/json"}, method="POST")
-        with request.urlopen(req, timeout=3) as resp:
-            return resp.getcode()
-    except error.HTTPError as e:
-        return e.code
+        code, _ = http_request("POST", url, data_bytes, {"Content-Type": "application/json"})
+        return code
     except Exception:
         return 0
 
 
 def http_delete(url: str) -> int:
     try:
-        req = request.Request(url, method="DELETE")
-        with request.urlopen(req, timeout=3) as resp:
-            return resp.getcode()
-    except error.HTTPError as e:
-        return e.code
+        code, _ = http_request("DELETE", url)
+        return code
     except Exception:
         return 0
 
 
-def get_existing_cameras(ip_address: str) -> str:
+def get_existing_cameras(ip_address: str):
     code, body = http_get(f"http://{ip_address}:7125/server/webcams/list")
-    if code and body and '"webcams"' in body:
-        return body
-    return ""
-
-
-def check_camera_exists(json_response: str, target_ip: str) -> bool:
-    return f"{target_ip}:8080" in json_response
-
-
-def extract_camera_name(json_response: str) -> str:
-    import re
-    m = re.search(r'"name"\s*:\s*"([^"]*)"', json_response)
-    return m.group(1) if m else ""
-
-
-def check_camera_configured_correctly(json_response: str, target_ip: str) -> bool:
-    good_stream = f'"stream_url"\s*:\s*"http://{target_ip}:8080/stream"' in json_response
-    good_snap = f'"snapshot_url"\s*:\s*"http://{target_ip}:8080/snapshot"' in json_response
-    good_service = '"service"\s*:\s*"mjpegstreamer"' in json_response
+    if not code or not body:
+        return None
+    try:
+        webcams = json.loads(body)["result"]["webcams"]
+    except (ValueError, KeyError, TypeError):
+        return None
+    if not isinstance(webcams, list):
+        return None
+    return [cam for cam in webcams if isinstance(cam, dict)]
+
+
+def find_camera(webcams: list, target_ip: str):
+    for cam in webcams:
+        urls = f"{cam.get('stream_url', '')} {cam.get('snapshot_url', '')}"
+        if f"{target_ip}:8080" in urls:
+            return cam
+    return None
+
+
+def check_camera_configured_correctly(cam: dict, target_ip: str) -> bool:
+    good_stream = cam.get("stream_url") == f"http://{target_ip}:8080/stream"
+    good_snap = cam.get("snapshot_url") == f"http://{target_ip}:8080/snapshot"
+    good_service = cam.get("service") == "mjpegstreamer"
     return good_stream and good_snap and good_service
 
 
-def extract_camera_details_for_report(json_response: str) -> None:
+def extract_camera_details_for_report(cam: dict) -> None:
     global REPORT_CAMERAS
-    import re
-    name = extract_camera_name(json_response)
-    m_service = re.search(r'"service"\s*:\s*"([^"]*)"', json_response)
-    m_enabled = re.search(r'"enabled"\s*:\s*([^,}]*)', json_response)
-    service = m_service.group(1) if m_service else ""
-    enabled = (m_enabled.group(1).strip() if m_enabled else "").replace('true', 'True').replace('false','False')
+    name = cam.get("name", "")
+    service = cam.get("service", "")
+    enabled = str(cam["enabled"]) if "enabled" in cam else ""
     REPORT_CAMERAS = f"NAME:{name}|SERVICE:{service}|ENABLED:{enabled}"
 
 
@@ -288,8 +327,7 @@ def delete_camera(ip_address: str, camera_name: str) -> bool:
     code = http_delete(f"http://{ip_address}:7125/server/webcams/item?name={encoded_name}")
     if code in (200, 204):
         log_action(f"  • Deleted camera: {camera_name}")
-        global REPORT_CAMERA_ACTIONS
-        REPORT_CAMERA_ACTIONS += f"Deleted camera: {camera_name}\n"
+        REPORT_CAMERA_ACTIONS.append(f"Deleted camera: {camera_name}")
         return True
     return False
 
@@ -305,8 +343,7 @@ def update_camera(ip_address: str, camera_name: str) -> bool:
     code = http_post(f"http://{ip_address}:7125/server/webcams/item?name={encoded_name}", payload)
     if code in (200, 201):
         log_action(f"  • Updated camera: {camera_name}")
-        global REPORT_CAMERA_ACTIONS
-        REPORT_CAMERA_ACTIONS += f"Updated camera: {camera_name}\n"
+        REPORT_CAMERA_ACTIONS.append(f"Updated camera: {camera_name}")
         return True
     return False
 
@@ -321,8 +358,8 @@ def create_camera(ip_address: str) -> bool:
     code = http_post(f"http://{ip_address}:7125/server/webcams/item", payload)
     if code in (200, 201):
         log_action("  • Camera created successfully")
-        global REPORT_CAMERA_ACTIONS, REPORT_CAMERA_STATUS
-        REPORT_CAMERA_ACTIONS += "Created new camera: Front\n"
+        global REPORT_CAMERA_STATUS
+        REPORT_CAMERA_ACTIONS.append("Created new camera: Front")
         REPORT_CAMERA_STATUS = "configured"
         return True
     else:
@@ -335,17 +372,18 @@ def manage_camera(ip_address: str) -> None:
     log_action("Configuring Moonraker webcam...")
     log_action("Checking for existing cameras...")
 
-    resp = get_existing_cameras(ip_address)
-    if not resp:
+    webcams = get_existing_cameras(ip_address)
+    if webcams is None:
         log_action("  • No response from server, creating new camera...")
         create_camera(ip_address)
         return
 
-    if check_camera_exists(resp, ip_address):
-        name = extract_camera_name(resp) or "Front"
+    cam = find_camera(webcams, ip_address)
+    if cam is not None:
+        name = cam.get("name") or "Front"
         log_action(f"  • Found camera: {name}")
-        extract_camera_details_for_report(resp)
-        if check_camera_configured_correctly(resp, ip_address):
+        extract_camera_details_for_report(cam)
+        if check_camera_configured_correctly(cam, ip_address):
             log_action("  • Configuration is correct, no changes needed")
             global REPORT_CAMERA_STATUS
             REPORT_CAMERA_STATUS = "already_configured"
@@ -363,7 +401,7 @@ def manage_camera(ip_address: str) -> None:
 
 def restart_moonraker() -> None:
     log_action("Restarting Moonraker service...")
-    if run_ok("/etc/init.d/moonraker restart"):
+    if run_ok(["/etc/init.d/moonraker", "restart"]):
         log_action("Moonraker service restarted successfully")
         log_service("Moonraker service restarted")
     else:
@@ -382,12 +420,12 @@ def print_final_report() -> None:
 
         if REPORT_BACKUPS_CREATED:
             print(f"{GREEN}✓ Backups:{NC}")
-            for line in REPORT_BACKUPS_CREATED.strip().splitlines():
+            for line in REPORT_BACKUPS_CREATED:
                 print(f"    • {line}")
 
         # Service status
-        if run("pidof ustreamer").returncode == 0:
-            p = run("pidof ustreamer")
+        p = run(["pidof", "ustreamer"])
+        if p.returncode == 0:
             pid = p.stdout.strip()
             print(f"{GREEN}✓ Service Status:{NC} Running (PID: {pid}") if pid else print(f"{GREEN}✓ Service Status:{NC} Running")
         else:
@@ -401,17 +439,6 @@ def print_final_report() -> None:
         else:
             print(f"{RED}✗ Camera:{NC} Configuration failed")
 
-        print("")
-        print(f"{YELLOW}Configuration:{NC}")
-        print(f"  • Resolution: {REPORT_USTREAMER_RESOLUTION} @ {REPORT_USTREAMER_FPS} fps")
-        print(f"  • Port: {REPORT_USTREAMER_PORT}")
-        print(f"  • Auto-restart: Every {REPORT_AUTO_RESTART_INTERVAL} minutes")
-
-        print("")
-        print(f"{YELLOW}Access URLs:{NC}")
-        print(f"  • Stream: http://{REPORT_IP}:{REPORT_USTREAMER_PORT}/stream")
-        print(f"  • Snapshot: http://{REPORT_IP}:{REPORT_USTREAMER_PORT}/snapshot")
-
     else:
         print(f"{RED}⚠ ERRORS ENCOUNTERED{NC}")
         print("")
@@ -419,11 +446,11 @@ def print_final_report() -> None:
             print(f"Installation: {REPORT_INSTALL_STATUS}")
         print("")
         print(f"{RED}Errors:{NC}")
-        for line in REPORT_ERRORS.strip().splitlines():
+        for line in REPORT_ERRORS:
             print(f"  • {line}")
         print("")
         print("Despite errors, attempting to show current status:")
-        if run("pidof ustreamer").returncode == 0:
+        if run_ok(["pidof", "ustreamer"]):
             print(f"  {GREEN}✓{NC} ustreamer is running")
         else:
             print(f"  {RED}✗{NC} ustreamer is not running")